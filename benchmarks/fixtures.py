@@ -0,0 +1,169 @@
+'''
+Synthetic YouTube pages for the benchmarks. The pages have the same layout
+as real watch pages (as of 2015): a long line of JavaScript with the
+fmt_list, url_encoded_fmt_stream_map and adaptive_fmts values, repeated a few
+times, surrounded by a lot of other HTML. Playlists and media files are
+synthetic too, so the benchmarks never need YouTube.
+'''
+
+import json
+import urllib
+import time
+
+# (itag, type, extra values) of every format on a synthetic watch page.
+PROGRESSIVE_FORMATS = [
+    ('22', 'video/mp4; codecs="avc1.64001F, mp4a.40.2"', {'quality': 'hd720'}),
+    ('43', 'video/webm; codecs="vp8.0, vorbis"', {'quality': 'medium'}),
+    ('18', 'video/mp4; codecs="avc1.42001E, mp4a.40.2"', {'quality': 'medium'}),
+    ('5', 'video/x-flv', {'quality': 'small'}),
+    ('36', 'video/3gpp; codecs="mp4v.20.3, mp4a.40.2"', {'quality': 'small'}),
+    ('17', 'video/3gpp; codecs="mp4v.20.3, mp4a.40.2"', {'quality': 'small'}),
+]
+ADAPTIVE_FORMATS = [
+    ('137', 'video/mp4; codecs="avc1.640028"', {'size': '1920x1080', 'fps': '30', 'bitrate': '4300000'}),
+    ('248', 'video/webm; codecs="vp9"', {'size': '1920x1080', 'fps': '30', 'bitrate': '2600000'}),
+    ('136', 'video/mp4; codecs="avc1.4d401f"', {'size': '1280x720', 'fps': '30', 'bitrate': '2200000'}),
+    ('247', 'video/webm; codecs="vp9"', {'size': '1280x720', 'fps': '30', 'bitrate': '1500000'}),
+    ('135', 'video/mp4; codecs="avc1.4d401f"', {'size': '854x480', 'fps': '30', 'bitrate': '1100000'}),
+    ('244', 'video/webm; codecs="vp9"', {'size': '854x480', 'fps': '30', 'bitrate': '800000'}),
+    ('134', 'video/mp4; codecs="avc1.4d401e"', {'size': '640x360', 'fps': '30', 'bitrate': '600000'}),
+    ('243', 'video/webm; codecs="vp9"', {'size': '640x360', 'fps': '30', 'bitrate': '400000'}),
+    ('133', 'video/mp4; codecs="avc1.4d4015"', {'size': '426x240', 'fps': '30', 'bitrate': '250000'}),
+    ('242', 'video/webm; codecs="vp9"', {'size': '426x240', 'fps': '30', 'bitrate': '200000'}),
+    ('160', 'video/mp4; codecs="avc1.4d400c"', {'size': '256x144', 'fps': '15', 'bitrate': '110000'}),
+    ('278', 'video/webm; codecs="vp9"', {'size': '256x144', 'fps': '15', 'bitrate': '95000'}),
+    ('140', 'audio/mp4; codecs="mp4a.40.2"', {'bitrate': '128000'}),
+    ('171', 'audio/webm; codecs="vorbis"', {'bitrate': '128000'}),
+    ('251', 'audio/webm; codecs="opus"', {'bitrate': '160000'}),
+    ('250', 'audio/webm; codecs="opus"', {'bitrate': '70000'}),
+    ('249', 'audio/webm; codecs="opus"', {'bitrate': '50000'}),
+]
+DIMENSIONS = {'22': '1280x720', '43': '640x360', '18': '640x360', '5': '426x240', \
+    '36': '426x240', '17': '256x144'}
+
+'''
+Get the size in bytes of a synthetic format of a video.
+    lengthSeconds - The length of the video.
+    itag - The format.
+'''
+def getFormatSize(lengthSeconds, itag):
+    for formatItag, formatType, extra in ADAPTIVE_FORMATS:
+        if formatItag == itag:
+            return int(extra['bitrate']) * lengthSeconds // 8
+    return 500000 * lengthSeconds // 8 # Progressive formats are all about 500 kbit/s.
+
+'''
+Make the URL of a format the way YouTube does: long, with lots of parameters.
+'''
+def makeFormatURL(baseURL, videoID, itag, lengthSeconds):
+    return baseURL + '/videoplayback?' + urllib.urlencode([ \
+        ('id', videoID), ('itag', itag), ('source', 'youtube'), \
+        ('requiressl', 'yes'), ('mime', 'video/mp4'), ('dur', '%d.000' % lengthSeconds), \
+        ('clen', str(getFormatSize(lengthSeconds, itag))), \
+        ('ip', '127.0.0.1'), ('ipbits', '0'), ('expire', str(int(time.time()) + 6 * 3600)), \
+        ('sparams', 'clen,dur,expire,id,ip,ipbits,itag,mime,requiressl,source'), \
+        ('signature', ('0123456789ABCDEF' * 5)[:40] + '.' + ('FEDCBA9876543210' * 5)[:40]), \
+        ('key', 'yt5'), ('upn', 'abcdefghijk')])
+
+'''
+Make a stream map value the way it appears in the JavaScript of a watch page.
+'''
+def makeStreamMap(baseURL, videoID, lengthSeconds, formats, adaptive):
+    formatStrings = []
+    for itag, formatType, extra in formats:
+        pairs = [('itag', itag), ('url', makeFormatURL(baseURL, videoID, itag, lengthSeconds)), \
+            ('type', formatType), ('fallback_host', 'tc.v1.cache1.googlevideo.com')]
+        if adaptive:
+            pairs += [('clen', str(getFormatSize(lengthSeconds, itag))), \
+                ('init', '0-708'), ('index', '709-1380'), ('lmt', '1439500000000000')]
+        pairs += sorted(extra.items())
+        formatStrings.append('\\u0026'.join(name + '=' + urllib.quote(value, safe='') \
+            for name, value in pairs))
+    return ','.join(formatStrings)
+
+'''
+Make a synthetic watch page.
+    videoID - The ID of the video.
+    baseURL - Where the format URLs point to, like http://127.0.0.1:8000.
+    lengthSeconds - The length of the video. This sets the size of each format.
+    title - The title of the video.
+    returns the HTML of the page.
+'''
+def makeWatchPage(videoID, baseURL='http://127.0.0.1:8000', lengthSeconds=60, title=None):
+    if title is None:
+        title = 'Benchmark video ' + videoID
+    fmtList = ','.join(itag + '\\/' + DIMENSIONS[itag] + '\\/9\\/0\\/115' \
+        for itag, formatType, extra in PROGRESSIVE_FORMATS)
+    config = '{"args":{"video_id":"%s","length_seconds":"%d","title":"%s","fmt_list":"%s",' \
+        '"url_encoded_fmt_stream_map":"%s","adaptive_fmts":"%s","keywords":"benchmark"}}' % \
+        (videoID, lengthSeconds, title, fmtList, \
+        makeStreamMap(baseURL, videoID, lengthSeconds, PROGRESSIVE_FORMATS, False), \
+        makeStreamMap(baseURL, videoID, lengthSeconds, ADAPTIVE_FORMATS, True))
+
+    lines = ['<!DOCTYPE html>', '<html lang="en">', '<head>', \
+        '<title>%s - YouTube</title>' % title]
+    # Real pages have a few hundred kB of markup and scripts around the video data.
+    filler = '<div class="yt-lockup-content"><a href="/watch?v=%s" class="yt-uix-sessionlink">Related video %d</a></div>'
+    lines += [filler % (videoID, i) for i in xrange(1500)]
+    lines.append('</head><body>')
+    for i in xrange(3): # The data is repeated about 3 times.
+        lines.append('<script>var ytplayer = ytplayer || {};ytplayer.config = %s;</script>' % config)
+        lines += [filler % (videoID, i) for i in xrange(500)]
+    lines += ['</body>', '</html>']
+    return '\n'.join(lines) + '\n'
+
+'''
+Make the first page of a synthetic playlist. Like a real playlist it has a
+row with data-video-ids for each video and, if there are more videos, a "Load
+more" button with the URL of the next page.
+    videoIDs - The IDs of the videos on this page.
+    moreURL - The URL of the next page, or None if this is the last one.
+    returns the HTML of the page.
+'''
+def makePlaylistPage(videoIDs, moreURL=None, title='Benchmark playlist'):
+    lines = ['<!DOCTYPE html>', '<html lang="en">', '<head>', \
+        '<title>%s - YouTube</title>' % title, '</head><body>', '<table id="pl-video-table">']
+    lines.append(makePlaylistRows(videoIDs))
+    lines.append('</table>')
+    lines.append(makeLoadMoreButton(moreURL))
+    lines += ['</body>', '</html>']
+    return '\n'.join(lines) + '\n'
+
+'''
+Make a page of a synthetic playlist after the first one. These are JSON, with
+the rows of the videos in content_html and the next "Load more" button in
+load_more_widget_html.
+    videoIDs - The IDs of the videos on this page.
+    moreURL - The URL of the next page, or None if this is the last one.
+    returns the JSON of the page.
+'''
+def makePlaylistContinuation(videoIDs, moreURL=None):
+    return json.dumps({'content_html': makePlaylistRows(videoIDs), \
+        'load_more_widget_html': makeLoadMoreButton(moreURL)})
+
+def makePlaylistRows(videoIDs):
+    row = '<tr class="pl-video yt-uix-tile" data-video-id="%s" data-video-ids="%s" data-title="Benchmark video %s">' \
+        '<td class="pl-video-title"><a href="/watch?v=%s&amp;list=PLbenchmark">Benchmark video %s</a></td></tr>'
+    return '\n'.join(row % ((videoID,) * 5) for videoID in videoIDs)
+
+def makeLoadMoreButton(moreURL):
+    if moreURL is None:
+        return ''
+    return '<button class="load-more-button yt-uix-load-more" data-uix-load-more-href="%s">Load more</button>' % \
+        moreURL.replace('&', '&amp;')
+
+# The bytes of a synthetic media file repeat this block.
+MEDIA_BLOCK = ''.join(chr(i % 251) for i in xrange(64 * 1024))
+
+'''
+Get part of a synthetic media file. Every file has the same bytes, so any
+range of one can be made without keeping the file in memory.
+    start - The offset of the first byte.
+    length - How many bytes to get.
+'''
+def getMediaData(start, length):
+    offset = start % len(MEDIA_BLOCK)
+    data = MEDIA_BLOCK[offset:offset + length]
+    while len(data) < length:
+        data += MEDIA_BLOCK[:length - len(data)]
+    return data
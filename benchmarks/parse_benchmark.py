@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+'''
+Compare the speed of the watch page parser with the parser it replaced.
+
+    python benchmarks/parse_benchmark.py [saved watch pages...]
+
+With no pages, a synthetic one from fixtures.py is used.
+'''
+
+import argparse
+import imp
+import os
+import re
+import time
+import urllib
+
+import fixtures
+
+youtubeGet = imp.load_source('youtube_get', \
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'youtube-get.py'))
+
+'''
+The old parser from download(): find the line with the stream map, cut the
+two maps out of it with regular expressions and parse each format by hand.
+    returns (fmtListDict, videos, adaptiveVideos) with a dict for each format.
+'''
+def legacyParse(html):
+    urlLine = 'no data'
+    for currentLine in html.splitlines():
+        if '\"url_encoded_fmt_stream_map\"' in currentLine:
+            urlLine = currentLine
+            break
+    if urlLine == 'no data':
+        return None
+
+    fmtListDict = None
+    match = re.search(r'"fmt_list":"([^"]+)"', urlLine)
+    if match:
+        fmtList = match.group(1).split(r',')
+        fmtListDict = {}
+        for i in xrange(len(fmtList)):
+            fmtList[i] = fmtList[i].split(r'\/')
+            fmtListDict[str(fmtList[i][0])] = fmtList[i][1]
+
+    adaptiveFmtLine = re.sub(r'.*"adaptive_fmts":"', '', urlLine)
+    adaptiveFmtLine = re.sub(r'",.*', '', adaptiveFmtLine)
+    urlLine = re.sub(r'.*"url_encoded_fmt_stream_map":"', '', urlLine)
+    urlLine = re.sub(r'",.*', '', urlLine)
+
+    allVideos = []
+    for videos in (urlLine.split(r','), adaptiveFmtLine.split(r',')):
+        for i in xrange(len(videos)):
+            videos[i] = str(videos[i]).decode('unicode-escape')
+            videos[i] = re.sub(r'\n', '', videos[i])
+            videos[i] = videos[i].split(r'&')
+            videoDataDict = {}
+            for j in xrange(len(videos[i])):
+                nameValue = videos[i][j].split(r'=')
+                videoDataDict[nameValue[0]] = nameValue[1]
+            videos[i] = videoDataDict
+        for i in xrange(len(videos)):
+            videos[i]['url'] = urllib.unquote(videos[i]['url'])
+            videos[i]['type'] = urllib.unquote(videos[i]['type'])
+            videos[i]['type'] = re.sub(r'[;&].*', '', videos[i]['type'])
+        allVideos.append(videos)
+
+    return fmtListDict, allVideos[0], allVideos[1]
+
+'''
+Time a parser.
+    returns the best time of one parse in seconds.
+'''
+def timeParser(parser, html, repeat, number):
+    best = None
+    for i in xrange(repeat):
+        startTime = time.time()
+        for j in xrange(number):
+            parser(html)
+        elapsed = (time.time() - startTime) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the watch page parser.')
+    parser.add_argument('pages', metavar='PAGE', nargs='*', \
+        help='A saved YouTube watch page. A synthetic page is used if none are given.')
+    parser.add_argument('-n', '--number', type=int, default=20, \
+        help='How many times to parse each page per measurement. The default is 20.')
+    parser.add_argument('-r', '--repeat', type=int, default=5, \
+        help='How many measurements to take. The best one is shown. The default is 5.')
+    args = parser.parse_args()
+
+    pages = []
+    for fileName in args.pages:
+        with open(fileName, 'rb') as pageFile:
+            pages.append((fileName, pageFile.read()))
+    if not pages:
+        pages.append(('synthetic page', fixtures.makeWatchPage('dQw4w9WgXcQ')))
+
+    print '%-30s : %8s : %10s : %10s : %7s' % ('PAGE', 'SIZE', 'OLD', 'NEW', 'SPEEDUP')
+    for name, html in pages:
+        newTime = timeParser(youtubeGet.parseWatchPage, html, args.repeat, args.number)
+        try:
+            oldTime = timeParser(legacyParse, html, args.repeat, args.number)
+        except (IndexError, KeyError):
+            # The old parser crashes on values with "=" in them and on missing keys.
+            oldTime = None
+        print '%-30s : %5d kB : %7.2f ms : %7.2f ms : %7s' % (os.path.basename(name)[-30:], \
+            len(html) // 1000, oldTime * 1000 if oldTime else float('nan'), newTime * 1000, \
+            '%.1fx' % (oldTime / newTime) if oldTime else 'crashed')
+
+if __name__ == '__main__':
+    main()
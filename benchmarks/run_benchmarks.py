@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+'''
+Time youtube-get.py against the local fixture server (server.py), so changes
+to parsing, downloading or --combine can be compared without YouTube.
+
+    python benchmarks/run_benchmarks.py [-o results.json] [--latency 0.05] [--bandwidth 4M]
+
+Each run of youtube-get.py is a separate process in an empty directory. The
+results are written as JSON with the settings they were measured with:
+
+    parse       Seconds to parse each watch page (the best of --repeat).
+    files       Reading saved watch pages with --files --simulate.
+    latency     Seconds from start to finish for single videos.
+    batch       A playlist with --jobs: videos and bytes per second.
+    playlist    Seconds to load every page of a playlist of more than
+                PLAYLIST_PAGE_SIZE videos. It stops with an error unless
+                every video is found exactly once, in order.
+    pieces      A video downloaded in 4 pieces (-k 4), and one interrupted
+                with Ctrl-C part way and resumed. It stops with an error
+                unless both are the same as the file on the server.
+    combine     Video and audio combined with ffmpeg, with temporary files
+                and with --stream-mux. Skipped if there's no ffmpeg.
+
+Every run of youtube-get.py also records its peak memory use (RSS). The
+latency and batch benchmarks stop with an error if the downloaded files
+aren't all there with the right sizes, so a broken download isn't timed.
+'''
+
+import argparse
+import distutils.spawn
+import json
+import os
+import platform
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import fixtures
+import parse_benchmark
+from server import FixtureServer, getSize, PLAYLIST_PAGE_SIZE
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(BENCHMARK_DIR, '..', 'youtube-get.py')
+SCENARIOS = ['parse', 'files', 'latency', 'batch', 'playlist', 'pieces', 'combine']
+INTERRUPT_DELAY = 0.3 # Seconds into a download to interrupt it in the pieces benchmark.
+
+'''
+Run youtube-get.py in a new empty directory.
+    arguments - The arguments to give it.
+    userInput - What to type at its prompts, if anything.
+    workDir - A directory to run it in instead, which is kept afterwards.
+    returns a dict with the seconds it took, its peak RSS in kB, its exit
+    status and the files it left (name -> size in bytes).
+'''
+def runScript(arguments, userInput=None, workDir=None):
+    keepDir = workDir is not None
+    if not keepDir:
+        workDir = tempfile.mkdtemp(prefix='youtube-get-benchmark_')
+    try:
+        with open(os.devnull, 'w') as devnull:
+            startTime = time.time()
+            process = subprocess.Popen([sys.executable, SCRIPT] + arguments, cwd=workDir, \
+                stdin=subprocess.PIPE, stdout=devnull, stderr=subprocess.STDOUT)
+            if userInput is not None:
+                process.stdin.write(userInput)
+            process.stdin.close()
+            # wait4() gives the resource use of this process alone.
+            pid, status, usage = os.wait4(process.pid, 0)
+            elapsed = time.time() - startTime
+            process.returncode = os.WEXITSTATUS(status)
+        files = dict((name, os.path.getsize(os.path.join(workDir, name))) for name in os.listdir(workDir))
+    finally:
+        if not keepDir:
+            shutil.rmtree(workDir)
+    if process.returncode != 0:
+        print >> sys.stderr, 'WARNING: youtube-get.py ' + ' '.join(arguments) + \
+            ' exited with ' + str(process.returncode)
+    return {'seconds': elapsed, 'peakRSSkB': usage.ru_maxrss, 'exitStatus': process.returncode, 'files': files}
+
+'''
+Stop with an error unless a run downloaded the expected number of files, all
+of the expected size.
+    run - What runScript() returned.
+    numFiles - How many files there should be.
+    size - The size of each file in bytes.
+'''
+def checkFiles(run, numFiles, size):
+    sizes = run['files'].values()
+    if len(sizes) != numFiles or any(fileSize != size for fileSize in sizes):
+        sys.exit('ERROR: Expected %d files of %d bytes, got %s' % (numFiles, size, \
+            ', '.join('%s (%d bytes)' % item for item in sorted(run['files'].items())) or 'none'))
+
+'''
+Summarize a list of numbers.
+'''
+def getStats(values):
+    values = sorted(values)
+    return {'min': values[0], 'median': values[len(values) // 2], 'max': values[-1], 'mean': sum(values) / len(values)}
+
+def benchmarkParse(server, args):
+    pages = []
+    if args.pages is not None:
+        for fileName in sorted(os.listdir(args.pages)):
+            # Video IDs have 11 characters. Longer names are recorded playlists.
+            if fileName.endswith('.html') and len(fileName) == 11 + len('.html'):
+                with open(os.path.join(args.pages, fileName), 'rb') as pageFile:
+                    pages.append((fileName, pageFile.read()))
+    if not pages:
+        pages.append(('synthetic', fixtures.makeWatchPage('dQw4w9WgXcQ', server.baseURL, args.length)))
+
+    results = {}
+    for name, html in pages:
+        seconds = parse_benchmark.timeParser(parse_benchmark.youtubeGet.parseWatchPage, html, args.repeat, 20)
+        results[name] = {'bytes': len(html), 'seconds': seconds}
+    return results
+
+def benchmarkFiles(server, args):
+    pageDir = tempfile.mkdtemp(prefix='youtube-get-benchmark_')
+    try:
+        fileNames = []
+        for i in xrange(args.videos):
+            fileName = os.path.join(pageDir, 'page%03d.html' % i)
+            with open(fileName, 'wb') as pageFile:
+                pageFile.write(fixtures.makeWatchPage('files%06d' % i, server.baseURL, args.length))
+            fileNames.append(fileName)
+        runs = [runScript(['-q', '-s', '-m', '-f'] + fileNames) for i in xrange(args.repeat)]
+    finally:
+        shutil.rmtree(pageDir)
+    return {'pages': args.videos, 'seconds': getStats([run['seconds'] for run in runs]), \
+        'peakRSSkB': max(run['peakRSSkB'] for run in runs)}
+
+def benchmarkLatency(server, args):
+    # -m picks the lowest quality, one of the progressive formats.
+    size = fixtures.getFormatSize(args.length, fixtures.PROGRESSIVE_FORMATS[-1][0])
+    runs = []
+    for i in xrange(args.repeat):
+        bytesBefore = server.bytesSent
+        run = runScript(['-q', '-m', '-k', str(args.connections), server.baseURL + '/watch?v=latency%04d' % i])
+        run['bytes'] = server.bytesSent - bytesBefore
+        checkFiles(run, 1, size)
+        runs.append(run)
+    return {'seconds': getStats([latencyRun['seconds'] for latencyRun in runs]), \
+        'bytes': runs[0]['bytes'], 'peakRSSkB': max(latencyRun['peakRSSkB'] for latencyRun in runs)}
+
+def benchmarkBatch(server, args):
+    size = fixtures.getFormatSize(args.length, fixtures.PROGRESSIVE_FORMATS[-1][0])
+    runs = []
+    for i in xrange(args.repeat):
+        bytesBefore = server.bytesSent
+        run = runScript(['-q', '-m', '-j', str(args.jobs), '-k', str(args.connections), \
+            server.baseURL + '/playlist?list=PLbatch%d' % i])
+        run['bytes'] = server.bytesSent - bytesBefore
+        checkFiles(run, args.videos, size)
+        runs.append(run)
+    best = min(runs, key=lambda batchRun: batchRun['seconds'])
+    return {'videos': args.videos, 'jobs': args.jobs, 'seconds': getStats([batchRun['seconds'] for batchRun in runs]), \
+        'videosPerSecond': args.videos / best['seconds'], 'bytesPerSecond': best['bytes'] / best['seconds'], \
+        'peakRSSkB': max(batchRun['peakRSSkB'] for batchRun in runs)}
+
+def benchmarkPlaylist(server, args):
+    # Two full pages after the first one, and a short last page.
+    numVideos = 3 * PLAYLIST_PAGE_SIZE + PLAYLIST_PAGE_SIZE // 2
+    playlistServer = FixtureServer(0, args.latency, args.bandwidth, None, args.length, numVideos)
+    playlistServer.start()
+    youtubeGet = parse_benchmark.youtubeGet
+    youtubeGet.args = argparse.Namespace(quiet=False)
+    youtubeGet.session = youtubeGet.Session(4, 15)
+    try:
+        startTime = time.time()
+        found = list(youtubeGet.getPlaylistVideoIDs(playlistServer.baseURL + '/playlist?list=PLcheck'))
+        seconds = time.time() - startTime
+        expected = playlistServer.getPlaylistVideoIDs('PLcheck')
+    finally:
+        # Close the kept-alive connections so the server's threads end before the program does.
+        for connections in youtubeGet.session.idle.values():
+            for connection, lastUsed in connections:
+                connection.close()
+        playlistServer.shutdown()
+    if found != expected:
+        sys.exit('ERROR: Expected the %d videos of the playlist once each, got %d (%d different)' % \
+            (len(expected), len(found), len(set(found))))
+    return {'videos': numVideos, 'pages': (numVideos + PLAYLIST_PAGE_SIZE - 1) // PLAYLIST_PAGE_SIZE, \
+        'seconds': seconds}
+
+'''
+Start youtube-get.py in workDir and press Ctrl-C part way through a download,
+once it has saved where its pieces start (the .part.json file). The part is
+kept for the next run to resume.
+    arguments - The arguments to give it.
+    workDir - The directory to run it in.
+'''
+def interruptScript(arguments, workDir):
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen([sys.executable, SCRIPT] + arguments, cwd=workDir, \
+            stdin=devnull, stdout=devnull, stderr=subprocess.STDOUT)
+        while process.poll() is None:
+            if any(name.endswith('.part.json') for name in os.listdir(workDir)):
+                time.sleep(INTERRUPT_DELAY)
+                process.send_signal(signal.SIGINT)
+                break
+            time.sleep(0.01)
+        process.wait()
+
+'''
+Stop with an error unless every file in a directory has the bytes of the
+synthetic media files.
+'''
+def checkContents(workDir):
+    for name in os.listdir(workDir):
+        with open(os.path.join(workDir, name), 'rb') as downloadedFile:
+            data = downloadedFile.read()
+        if data != fixtures.getMediaData(0, len(data)):
+            sys.exit('ERROR: ' + name + ' isn\'t the same as the file on the server')
+
+def benchmarkPieces(server, args):
+    # The files need to be big enough to split in 4 (see MIN_SEGMENT_SIZE in
+    # youtube-get.py), and slow enough to interrupt part way.
+    lengthSeconds = 80
+    size = fixtures.getFormatSize(lengthSeconds, fixtures.PROGRESSIVE_FORMATS[-1][0])
+    piecesServer = FixtureServer(0, args.latency, 1024 ** 2, None, lengthSeconds)
+    piecesServer.start()
+    workDir = tempfile.mkdtemp(prefix='youtube-get-benchmark_')
+    try:
+        whole = runScript(['-q', '-m', '-k', '4', piecesServer.baseURL + '/watch?v=pieces0000'], workDir=workDir)
+        checkFiles(whole, 1, size)
+        checkContents(workDir)
+        for name in os.listdir(workDir):
+            os.remove(os.path.join(workDir, name))
+
+        arguments = ['-q', '-m', '-k', '4', piecesServer.baseURL + '/watch?v=pieces0001']
+        interruptScript(arguments, workDir)
+        if not any(name.endswith('.part.json') for name in os.listdir(workDir)):
+            sys.exit('ERROR: The download wasn\'t interrupted part way, so resuming wasn\'t checked')
+        resumed = runScript(arguments, workDir=workDir)
+        checkFiles(resumed, 1, size)
+        checkContents(workDir)
+    finally:
+        shutil.rmtree(workDir)
+        piecesServer.shutdown()
+    return {'bytes': size, 'seconds': whole['seconds'], 'resumeSeconds': resumed['seconds']}
+
+def benchmarkCombine(server, args):
+    if distutils.spawn.find_executable('ffmpeg') is None:
+        print >> sys.stderr, 'Skipping combine: ffmpeg wasn\'t found.'
+        return None
+    # The first adaptive video comes right after the progressive ones.
+    videoNum = str(len(fixtures.PROGRESSIVE_FORMATS) + 1) + '\n'
+    results = {}
+    for name, extra in (('tempFiles', []), ('streamMux', ['--stream-mux'])):
+        runs = [runScript(['-q', '-c', '-k', str(args.connections)] + extra + \
+            [server.baseURL + '/watch?v=combine%04d' % i], videoNum) for i in xrange(args.repeat)]
+        results[name] = {'seconds': getStats([run['seconds'] for run in runs]), \
+            'peakRSSkB': max(run['peakRSSkB'] for run in runs)}
+    return results
+
+'''
+Get the commit the benchmarks are run on, if this is a git checkout.
+'''
+def getCommit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARK_DIR, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark youtube-get.py against a local fixture server.')
+    parser.add_argument('scenarios', metavar='SCENARIO', nargs='*', \
+        help='What to run: ' + ', '.join(SCENARIOS) + '. The default is all of them.')
+    parser.add_argument('-o', '--output', metavar='FILE', \
+        help='Write the results to FILE. The default is to print them.')
+    parser.add_argument('--latency', type=float, default=0.02, \
+        help='Seconds the server waits before each response. The default is 0.02.')
+    parser.add_argument('--bandwidth', type=getSize, default=8 * 1024 ** 2, \
+        help='The most bytes per second on each connection, like 2M. 0 is no limit. The default is 8M.')
+    parser.add_argument('--length', type=int, default=10, \
+        help='The length of the synthetic videos in seconds. This sets their sizes. The default is 10.')
+    parser.add_argument('--videos', type=int, default=20, \
+        help='How many videos are in the batch playlist and in the files benchmark. The default is 20.')
+    parser.add_argument('-j', '--jobs', type=int, default=4, \
+        help='The --jobs for the batch benchmark. The default is 4.')
+    parser.add_argument('-k', '--connections', type=int, default=1, \
+        help='The --connections for every download. The default is 1.')
+    parser.add_argument('-r', '--repeat', type=int, default=3, \
+        help='How many times to run each benchmark. The default is 3.')
+    parser.add_argument('--pages', metavar='DIR', \
+        help='A directory of recorded watch pages (VIDEO_ID.html) to parse and serve, and playlist pages (PLAYLIST_ID.html) to serve.')
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario: ' + name)
+
+    server = FixtureServer(0, args.latency, args.bandwidth, args.pages, args.length, args.videos)
+    server.start()
+
+    functions = {'parse': benchmarkParse, 'files': benchmarkFiles, 'latency': benchmarkLatency, \
+        'batch': benchmarkBatch, 'playlist': benchmarkPlaylist, 'pieces': benchmarkPieces, \
+        'combine': benchmarkCombine}
+    results = {}
+    for name in args.scenarios or SCENARIOS:
+        print >> sys.stderr, 'Running ' + name + '...'
+        results[name] = functions[name](server, args)
+
+    report = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': getCommit(), \
+        'python': platform.python_version(), 'platform': platform.platform(), \
+        'settings': {'latency': args.latency, 'bandwidth': args.bandwidth, 'length': args.length, \
+            'videos': args.videos, 'jobs': args.jobs, 'connections': args.connections, 'repeat': args.repeat}, \
+        'results': results}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output is None:
+        print text
+    else:
+        with open(args.output, 'w') as outFile:
+            outFile.write(text + '\n')
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
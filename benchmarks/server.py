@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+'''
+A local stand-in for YouTube for the benchmarks. It serves watch pages,
+playlists and media files with a set delay before each response and a set
+speed for each connection, so downloads can be timed without the network.
+
+    python benchmarks/server.py [--port 8000] [--latency 0.05] [--bandwidth 2M]
+
+    /watch?v=ID           A watch page. It's read from the --pages directory
+                          (ID.html) if it's there, otherwise it's synthetic.
+    /playlist?list=ID     The first page of a playlist. It's read from the
+                          --pages directory (ID.html) if it's there. Otherwise
+                          it's a synthetic playlist of --playlist-size videos.
+    /browse_ajax?...      The other pages of a playlist.
+    /videoplayback?...    A synthetic media file of clen bytes. Ranges work.
+'''
+
+import argparse
+import BaseHTTPServer
+import os
+import re
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import urllib
+import urlparse
+
+import fixtures
+
+PLAYLIST_PAGE_SIZE = 100 # Videos on each page of a playlist, like YouTube.
+SEND_SIZE = 16 * 1024 # How much of a media file to send at a time.
+
+'''
+Handles one connection. Connections are kept open between requests
+(HTTP/1.1), the way the YouTube servers do it.
+'''
+class FixtureHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def do_GET(self):
+        self.respond(True)
+
+    def respond(self, sendBody):
+        time.sleep(self.server.latency)
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        with self.server.lock:
+            self.server.numRequests += 1
+
+        if url.path == '/watch' and 'v' in query:
+            self.sendPage(self.server.getWatchPage(query['v']), 'text/html; charset=utf-8', sendBody)
+        elif url.path == '/playlist' and 'list' in query:
+            self.sendPage(self.server.getPlaylistPage(query['list'], 0), 'text/html; charset=utf-8', sendBody)
+        elif url.path == '/browse_ajax' and 'list' in query and 'start' in query:
+            self.sendPage(self.server.getPlaylistPage(query['list'], int(query['start'])), \
+                'application/json; charset=utf-8', sendBody)
+        elif url.path == '/videoplayback' and 'clen' in query:
+            self.sendMedia(int(query['clen']), sendBody)
+        else:
+            self.sendPage('Not found', 'text/plain', sendBody, 404)
+
+    def sendPage(self, page, contentType, sendBody, code=200):
+        self.send_response(code)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(page)))
+        self.end_headers()
+        if sendBody:
+            self.sendData(page)
+
+    def sendMedia(self, size, sendBody):
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), size - 1)
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if not sendBody:
+            return
+        offset = start
+        while offset <= end:
+            length = min(SEND_SIZE, end - offset + 1)
+            self.sendData(fixtures.getMediaData(offset, length))
+            offset += length
+
+    '''
+    Send data no faster than --bandwidth.
+    '''
+    def sendData(self, data):
+        bandwidth = self.server.bandwidth
+        for i in xrange(0, len(data), SEND_SIZE):
+            startTime = time.time()
+            self.wfile.write(data[i:i + SEND_SIZE])
+            if bandwidth:
+                wait = float(min(SEND_SIZE, len(data) - i)) / bandwidth - (time.time() - startTime)
+                if wait > 0:
+                    time.sleep(wait)
+        with self.server.lock:
+            self.server.bytesSent += len(data)
+
+    def log_message(self, format, *args):
+        pass
+
+'''
+The fixture server. Each connection gets its own thread.
+    port - The port to listen on. 0 picks a free one.
+    latency - Seconds to wait before each response.
+    bandwidth - The most bytes per second to send on each connection, or 0
+    for no limit.
+    pagesDir - A directory of recorded watch and playlist pages named ID.html,
+    or None. Only the first page of a recorded playlist can be served: its
+    "Load more" URLs are YouTube's, so they get a 404.
+    lengthSeconds - The length of the synthetic videos. This sets their sizes.
+    playlistSize - How many videos are in each playlist.
+'''
+class FixtureServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, latency=0, bandwidth=0, pagesDir=None, lengthSeconds=60, playlistSize=20):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), FixtureHandler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.pagesDir = pagesDir
+        self.lengthSeconds = lengthSeconds
+        self.playlistSize = playlistSize
+        self.baseURL = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.lock = threading.Lock()
+        self.numRequests = 0
+        self.bytesSent = 0
+        self.watchPages = {} # Synthetic pages are slow to make, so keep them.
+
+    '''
+    Report an error from a connection. Clients that go away part way through
+    a response, like an interrupted download, are expected and not reported.
+    '''
+    def handle_error(self, request, clientAddress):
+        if not isinstance(sys.exc_info()[1], socket.error):
+            SocketServer.TCPServer.handle_error(self, request, clientAddress)
+
+    '''
+    Read a recorded page from the --pages directory.
+        returns the page, or None if there isn't one named pageID.html.
+    '''
+    def getRecordedPage(self, pageID):
+        if self.pagesDir is not None:
+            fileName = os.path.join(self.pagesDir, os.path.basename(pageID) + '.html')
+            if os.path.exists(fileName):
+                with open(fileName, 'rb') as pageFile:
+                    return pageFile.read()
+        return None
+
+    def getWatchPage(self, videoID):
+        page = self.getRecordedPage(videoID)
+        if page is not None:
+            return page
+        with self.lock:
+            if videoID not in self.watchPages:
+                self.watchPages[videoID] = fixtures.makeWatchPage(videoID, self.baseURL, self.lengthSeconds)
+            return self.watchPages[videoID]
+
+    '''
+    Get the page of a playlist that starts with video number start.
+    '''
+    def getPlaylistPage(self, playlistID, start):
+        if start == 0:
+            page = self.getRecordedPage(playlistID)
+            if page is not None:
+                return page
+        videoIDs = self.getPlaylistVideoIDs(playlistID)
+        end = start + PLAYLIST_PAGE_SIZE
+        moreURL = None
+        if end < len(videoIDs):
+            moreURL = '/browse_ajax?' + urllib.urlencode([('action_continuation', '1'), \
+                ('list', playlistID), ('start', str(end))])
+        if start == 0:
+            return fixtures.makePlaylistPage(videoIDs[start:end], moreURL)
+        return fixtures.makePlaylistContinuation(videoIDs[start:end], moreURL)
+
+    '''
+    Make up the IDs of the videos in a playlist. They're 11 characters like
+    real ones and depend only on the playlist ID, so each run gets the same ones.
+    '''
+    def getPlaylistVideoIDs(self, playlistID):
+        return [(playlistID[:6] + '%05d' % i)[-11:].rjust(11, '_') for i in xrange(self.playlistSize)]
+
+    '''
+    Serve in a background thread.
+    '''
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+'''
+Read a number of bytes like "500K" or "2M".
+'''
+def getSize(text):
+    match = re.match(r'^(\d+(?:\.\d+)?)([kKmMgG]?)$', text)
+    if not match:
+        raise argparse.ArgumentTypeError('not a size: ' + text)
+    return float(match.group(1)) * {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}[match.group(2).lower()]
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve YouTube fixtures for the benchmarks.')
+    parser.add_argument('--port', type=int, default=8000, help='The port to listen on. The default is 8000.')
+    parser.add_argument('--latency', type=float, default=0, \
+        help='Seconds to wait before each response. The default is 0.')
+    parser.add_argument('--bandwidth', type=getSize, default=0, \
+        help='The most bytes per second on each connection, like 2M. The default is no limit.')
+    parser.add_argument('--pages', metavar='DIR', \
+        help='A directory of recorded watch pages named VIDEO_ID.html and playlist pages named PLAYLIST_ID.html.')
+    parser.add_argument('--length', type=int, default=60, \
+        help='The length of the synthetic videos in seconds. The default is 60.')
+    parser.add_argument('--playlist-size', dest='playlistSize', type=int, default=20, \
+        help='How many videos are in each playlist. The default is 20.')
+    args = parser.parse_args()
+
+    server = FixtureServer(args.port, args.latency, args.bandwidth, args.pages, args.length, args.playlistSize)
+    print 'Serving on ' + server.baseURL
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
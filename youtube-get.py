@@ -4,25 +4,162 @@ Download YouTube videos.
 
 Author:  Stephen Nanney.
 Version: 2015-08-16
+'''
 
 import urllib
 import subprocess # Used for calling external commands.
 import os # Used for testing if a certain file name is taken.
 import argparse # Handles arguments.
-import mechanize # Allows for easy downloading of files. See https://views.scraperwiki.com/run/python_mechanize_cheat_sheet/
+import urllib2 # For HTTP errors and file:// URLs.
+import cookielib # Keeps the cookies that servers send.
+import httplib # Talks to the servers. Connections are kept open and reused.
+import urlparse # Splits up URLs for the connection pool.
+import socket # For network errors.
+import HTMLParser # Decodes HTML entities in video titles and playlist pages.
 import re # Regex
 import codecs
 import mimetypes # For getting the file extension of the file.
 import sys # For printing to standard error.
+import threading # Runs several downloads at once (--jobs).
+import Queue # Hands videos to the download threads.
+import StringIO # Holds the output of each download thread until it can be printed in order.
+import time # Times the downloads for the summary.
+import traceback # Reports unexpected errors in download threads.
+import json # For the files that keep track of partly downloaded files.
+import atexit # Saves the progress of interrupted downloads.
+import tempfile # For the named pipes used by --stream-mux.
+import shutil # Removes the directory of the named pipes.
+import errno # Tells apart the errors from named pipes.
+import fcntl # Switches named pipes between blocking and non-blocking writes.
+import BaseHTTPServer # Serves the job API of the daemon (--daemon).
+import SocketServer
+import stat
+import signal
+import multiprocessing # Parses saved pages in several processes (--extract).
+import glob
+import hashlib # Hashes downloads as they're saved (--hash).
+
+pool = None # The DownloadPool used when downloading several videos at once (--jobs).
+jobQueue = None # The JobQueue of the daemon (--daemon).
+jobContext = threading.local() # The Job that each daemon thread is working on.
+session = None # The Session used for every web page and download.
+cache = None # The MetadataCache of video data (--cache), if it's used.
+archive = None # The DownloadArchive of finished downloads (--archive), if it's used.
+manifest = None # URL -> VideoInfo of the videos in the --manifest file or found ahead of time for --order, if either is used.
+store = None # The ContentStore of downloaded files (--store), if it's used.
+limiter = None # The BandwidthLimiter for --limit-rate, if it's used.
+metricsLog = None # The MetricsLog for --metrics, if it's used.
+speedEstimate = None # The SpeedEstimate of the downloads so far, for --max-time.
+activeTransfers = set() # Every Transfer that is downloading right now.
+stopping = threading.Event() # Set on Ctrl-C so the threads downloading pieces stop too.
+scheduled = [] # (url, deadline) of the videos waiting for --order.
+outputIndexes = {} # Directory -> OutputIndex of the names of the files in it.
+outputIndexLock = threading.Lock()
+
+USER_AGENT = 'Mozilla/5.0 (X11; U; Linux i686; en-US; rv:1.9.0.1) Gecko/2008071615 Fedora/3.0.1-1.fc9 Firefox/3.0.1'
+CHUNK_SIZE = 64 * 1024 # How much of a download to read at a time.
+MB = 1024.0 * 1024 # What "M" means in sizes like --max-size 3M. Sizes are shown in it too.
+MIN_SEGMENT_SIZE = 1024 * 1024 # Don't split downloads into pieces smaller than this (--connections).
+MAX_REDIRECTS = 10
+# Finds the format data in a watch page: "name":"value" where value is a JSON string.
+STREAM_MAP_PATTERN = re.compile(r'"(url_encoded_fmt_stream_map|adaptive_fmts|fmt_list)":"([^"\\]*(?:\\.[^"\\]*)*)"')
+VIDEO_ID_PATTERN = re.compile(r'"video_id":"([^"]+)"')
+# Playlist pages have a data-video-ids attribute for each video and a "Load more" button with the URL of the next page.
+PLAYLIST_VIDEO_PATTERN = re.compile(r'data-video-ids="([^"]+)"')
+LOAD_MORE_PATTERN = re.compile(r'data-uix-load-more-href="([^"]+)"')
+CACHE_EXPIRE_MARGIN = 15 * 60 # Don't use cached stream URLs that expire sooner than this many seconds from now.
+DEFAULT_SPEED = MB # Bytes per second to expect for --max-time before anything has been downloaded.
+SOCKET_TIMEOUT = 60 # Seconds to wait on a server before giving up.
+MIRROR_CHECK_TIME = 3 # Seconds between checks of the speed of each download for --mirrors.
+VERIFY_RETRIES = 2 # Times to download a file again when it comes out the wrong size.
+STOP_WAIT = 2 # Seconds to wait for download threads to stop after Ctrl-C.
+PREFETCH_THREADS = 8 # Watch pages to get at the same time before downloading with --order.
 
 def main():
 
     getArguments()
 
-    if args.files:
-        getVideosFromFiles()
+    # Keep track of interrupted downloads so they can be continued later.
+    atexit.register(saveActiveTransfers)
+
+    global session
+    session = Session(args.poolSize, args.keepAlive)
+
+    global cache
+    if args.cacheDir is not None:
+        cache = MetadataCache(os.path.expanduser(args.cacheDir), args.cacheTTL, args.cacheSize)
+
+    global archive
+    if args.archive is not None:
+        archive = DownloadArchive(os.path.expanduser(args.archive))
+
+    global store
+    if args.store is not None:
+        store = ContentStore(os.path.expanduser(args.store))
+
+    global limiter
+    if args.limitRate is not None:
+        limiter = BandwidthLimiter(args.limitRate)
+
+    global metricsLog
+    if args.metrics is not None:
+        metricsLog = MetricsLog(os.path.expanduser(args.metrics))
+
+    global speedEstimate
+    speedEstimate = SpeedEstimate()
+
+    # Take jobs until stopped, instead of downloading the given videos and quitting.
+    if args.daemon is not None:
+        runDaemon(args.daemon)
+        return
+
+    # Only parse saved pages, without downloading anything.
+    if args.extract is not None:
+        extractFiles(args.extract)
+        return
+
+    # Only get the formats of the videos, without downloading anything.
+    if args.crawl is not None:
+        crawl(args.crawl)
+        return
+
+    # Run the downloads in parallel if asked to.
+    global pool
+    if args.jobs > 1:
+        sys.stdout = ThreadOutput(sys.stdout)
+        pool = DownloadPool(args.jobs)
+
+    try:
+        if args.manifest is not None:
+            getVideosFromManifest(args.manifest)
+        elif args.files:
+            getVideosFromFiles()
+        else:
+            getVideosFromURLs()
+
+        if args.order != 'given':
+            downloadScheduled()
+    except KeyboardInterrupt:
+        # Most of a long batch is spent waiting for room in the pool's queue.
+        stopThreads(pool.threads if pool is not None else [])
+        raise
+
+    if pool is not None:
+        pool.finish()
+
+'''
+Download the video at url, either right away or in the download pool (--jobs).
+With --order it waits until every video is known, see downloadScheduled().
+    url - The URL of the video to download.
+    deadline - Seconds from the start by when it should be done, or None.
+'''
+def queueDownload(url, deadline=None):
+    if args.order != 'given':
+        scheduled.append((url, deadline))
+    elif pool is None:
+        download(url)
     else:
-        getVideosFromURLs()
+        pool.submit(url)
 
 '''
 Interpret the list of arguments as URLs of the videos to download.
@@ -35,32 +172,56 @@ def getVideosFromURLs():
 
     # Download every video.
     for i in xrange(len(args.URLs)):
+        argument = args.URLs[i]
+        deadline = None
+        # With --order deadline, an argument can end in @SECONDS.
+        match = re.match(r'(.+)@(\d+(?:\.\d+)?)$', argument)
+        if args.order == 'deadline' and match:
+            argument, deadline = match.group(1), float(match.group(2))
+        for url in getArgumentURLs(argument):
+            queueDownload(url, deadline)
 
-        url = args.URLs[i]
-
-        # If we have just the video ID, create the full URL.
-        if (not url.startswith(r'http://')) and (not url.startswith(r'https://')):
-            url = r'http://www.youtube.com/watch?v=' + url
-            download(url)
-
-        # The argument is a video with a full URL.
-        elif re.search(r'watch\?v=', url) or \
-             re.search(r'watch\?.*&v=', url) or \
-             re.search(r'youtu.be/', url):
-            download(url)
-
-        # The argument is a playlist.
-        elif re.search('playlist\?list=', url):
-            # Get the ID for each video in the playlist.
-            playlistURLs = getPlaylistURLs(url)
-            # Download each video.
-            for j in xrange(len(playlistURLs)):
-                download(r'http://www.youtube.com/watch?v=' + playlistURLs[j])
+'''
+Find the videos that an argument stands for.
+    url - A video URL, a video ID or a playlist URL.
+    returns a generator of the URLs of the videos. The videos of a playlist
+    are generated as they're found.
+'''
+def getVideoURLs(url):
+    # If we have just the video ID, create the full URL.
+    if (not url.startswith(r'http://')) and (not url.startswith(r'https://')):
+        url = r'http://www.youtube.com/watch?v=' + url
+        yield url
+
+    # The argument is a video with a full URL.
+    elif re.search(r'watch\?v=', url) or \
+         re.search(r'watch\?.*&v=', url) or \
+         re.search(r'youtu.be/', url):
+        yield url
+
+    # The argument is a playlist.
+    elif re.search('playlist\?list=', url):
+        for videoID in getPlaylistVideoIDs(url):
+            yield urlparse.urljoin(url, '/watch?v=' + videoID)
+
+    # We don't know what this is.
+    else:
+        if not args.quiet:
+            print '\nERROR: Confusing argument: ' + url + '\n'
 
-        # We don't know what this is.
-        else:
-            if not args.quiet:
-                print '\nERROR: Confusing argument: ' + url + '\n'
+'''
+Find the videos that a command line argument stands for, like getVideoURLs(),
+but report a playlist that can't be read instead of stopping the batch.
+    argument - A video URL, a video ID or a playlist URL.
+    returns a generator of the URLs of the videos.
+'''
+def getArgumentURLs(argument):
+    try:
+        for url in getVideoURLs(argument):
+            yield url
+    except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+        if not args.quiet:
+            print '\nERROR: Couldn\'t read the playlist: ' + argument + '\n' + str(e) + '\n'
 
 '''
 Interpret the list of arguments as local HTML files of the videos to download.
@@ -76,176 +237,293 @@ def getVideosFromFiles():
 
         url = 'file://' + os.path.abspath(args.URLs[i])
 
-        download(url)
+        queueDownload(url)
 
 '''
-Download the video at url.
-    url - The URL or video ID of the video to download.
+Parse saved watch pages in parallel and write what's found to a manifest
+(--extract). Parsing is slow compared to reading the files, so it's split
+between several processes. The manifest has a line of JSON for each page:
+the VideoInfo and the name of the file. It can be downloaded later with
+--manifest, on this computer or another one.
+    manifestName - The file to write, or "-" for stdout.
 '''
-def download(url):
-
-    if args.debug or args.superDebug:
-        print "URL: " + url
+def extractFiles(manifestName):
+    # No files were given on the command line. Get them from user input.
+    if len(args.URLs) == 0:
+        userInput = raw_input('Please enter one or more HTML files or directories:\n')
+        args.URLs = userInput.split() # Split by runs of consecutive whitespace.
 
-    browser = mechanize.Browser()
-    #browser.set_all_readonly(False) # allow everything to be written to
-    browser.set_handle_robots(False) # no robots
-    browser.set_handle_refresh(False) # can sometimes hang without this
-    browser.addheaders = [('User-agent', 'Mozilla/5.0 (X11; U; Linux i686; en-US; rv:1.9.0.1) Gecko/2008071615 Fedora/3.0.1-1.fc9 Firefox/3.0.1')]
+    fileNames = []
+    for name in args.URLs:
+        if os.path.isdir(name):
+            fileNames += sorted(glob.glob(os.path.join(name, '*.htm')) + glob.glob(os.path.join(name, '*.html')))
+        else:
+            fileNames.append(name)
+
+    startTime = time.time()
+    numProcesses = args.jobs if args.jobs > 1 else multiprocessing.cpu_count()
+    # Messages from the processes mustn't go between the lines of a manifest on stdout.
+    processes = multiprocessing.Pool(numProcesses, printToStderr if manifestName == '-' else None)
+    manifestFile = sys.stdout if manifestName == '-' else open(manifestName, 'w')
+    numFound = 0
+    try:
+        # imap() keeps the order of the files and gives each result as soon as it's ready.
+        for record in processes.imap(extractFile, fileNames, 16):
+            if record is not None:
+                manifestFile.write(json.dumps(record, sort_keys=True) + '\n')
+                numFound += 1
+    finally:
+        processes.terminate()
+        if manifestFile is not sys.stdout:
+            manifestFile.close()
+
+    if not args.quiet and manifestFile is not sys.stdout:
+        print 'Found %d of %d videos in %.1f s with %d processes.' % (numFound, len(fileNames), \
+            time.time() - startTime, numProcesses)
 
+'''
+Parse one saved watch page. This runs in the processes of extractFiles().
+    fileName - The HTML file.
+    returns the manifest record, or None if there was an error.
+'''
+def extractFile(fileName):
     try:
-        htmlHandle = browser.open(url)
-    except mechanize.HTTPError, e:
+        with open(fileName, 'rb') as htmlFile:
+            html = htmlFile.read()
+    except IOError, e:
         if not args.quiet:
-            print '\nERROR: HTTP error for ' + url
-            print 'Maybe there\'s a 404 error?\n'
-        return
-    except mechanize.URLError, e:
-        if not args.quiet:
-            print '\nERROR: mechanize.URLError for ' + url
-            print 'Maybe there\'s a network connectivity problem?\n'
-        return
-        URLError
-    videoTitle = browser.title() # Get the title of the video.
-    videoTitle = re.sub(' - YouTube$', '', videoTitle) # Get rid of the "- YouTube" bit at the end.
-    videoTitle = re.sub(r'\/', r'_', videoTitle) # Replace forward slashes with underscores (because Linux).
-
-    if args.appendId:
-        match = re.search(r'[\?&]v=([^&]+)', url)
-        if match:
-            videoTitle += ' - YouTube ' + match.group(1)
+            print '\nERROR: Couldn\'t read ' + fileName + ': ' + str(e) + '\n'
+        return None
+    info = parseVideoInfo(html, 'file://' + os.path.abspath(fileName), None)
+    if info is None:
+        return None
+    record = info.toDict()
+    record['file'] = os.path.abspath(fileName)
+    return record
 
-    urlLine = 'no data' # Value kept if no video data is found.
-
-    for currentLine in htmlHandle:
-        # Find the line with video urls. They have "url_encoded_fmt_stream_map" in them.
-        if '\"url_encoded_fmt_stream_map\"' in currentLine:
-            urlLine = currentLine
-            break # The same urls are repeated in about 3 lines. We only need one.
-                  # We can collect all lines with urls later if they're needed.
-
-    htmlHandle.close()
-
-    # If urlLine is None then we haven't found good data.
-    if urlLine == 'no data':
-        if not args.quiet:
-            print '\nERROR 113: No video data found for ' + url + '\n'
-        return
+'''
+Send everything the current process prints to stderr.
+'''
+def printToStderr():
+    sys.stdout = sys.stderr
 
-    match = re.search(r'"fmt_list":"([^"]+)"', urlLine)
-    if not match: # fmt_list data not found
-        fmtListFound = False
+'''
+Get the formats of many videos without downloading them (--crawl). The watch
+pages are fetched by many threads at once (--jobs, 16 by default), with at
+most --crawl-per-host requests to each server at a time. A line of JSON is
+written for each video as soon as it's done, so the order isn't kept: the
+VideoInfo and the URL, or the URL and the error.
+    outputName - The file to write, or "-" for stdout.
+'''
+def crawl(outputName):
+    realStdout = sys.stdout
+    # Messages about a video go into its record, and other messages don't go
+    # between the records.
+    sys.stdout = ThreadOutput(sys.stderr if outputName == '-' else sys.stdout)
+    outFile = realStdout if outputName == '-' else open(outputName, 'w')
+    outLock = threading.Lock()
+    hostLimits = {} # Host -> threading.BoundedSemaphore.
+    hostLock = threading.Lock()
+    counts = {'found': 0, 'failed': 0}
+
+    def fetch(url):
+        host = urlparse.urlsplit(url).netloc
+        with hostLock:
+            if host not in hostLimits:
+                hostLimits[host] = threading.BoundedSemaphore(args.crawlPerHost)
+            hostLimit = hostLimits[host]
+
+        sys.stdout.startBuffer()
+        try:
+            with hostLimit:
+                info = getVideoInfo(url, True)
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+            info = None
+        output = sys.stdout.stopBuffer().strip()
+
+        if info is not None:
+            record = info.toDict()
+            record['url'] = url
+        else:
+            record = {'url': url, 'error': output or 'Unknown error'}
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with outLock:
+            outFile.write(line)
+            outFile.flush()
+            counts['found' if info is not None else 'failed'] += 1
+
+    startTime = time.time()
+    # Read the videos from stdin if there are none on the command line, one per line.
+    arguments = args.URLs if args.URLs else (line.strip() for line in sys.stdin if line.strip())
+    urls = (url for argument in arguments for url in getArgumentURLs(argument))
+    runWorkers(urls, fetch, args.jobs if args.jobs > 1 else 16, 'crawl')
+
+    if outFile is not realStdout:
+        outFile.close()
         if not args.quiet:
-            print '\nERROR NUMBER 112: No fmt_list data found for ' + url + '\n'
-    else: # fmt_list data found
-        fmtListFound = True
-        fmtList = match.group(1)
-        # The formats are separated by commas.
-        fmtList = fmtList.split(r',')
-        fmtListDict = {}
-        # The comma-separated items are each separated by back and forward slashes (\/).
-        for i in xrange(len(fmtList)):
-            fmtList[i] = fmtList[i].split(r'\/')
-            fmtListDict[str(fmtList[i][0])] = fmtList[i][1] # Add this data to a dict.
-
-    # Get the adaptive_fmts data. This has the video and audio split up.
-    # Remove the beginning of the line. Keep the urls.
-    adaptiveFmtLine = re.sub(r'.*"adaptive_fmts":"', '', urlLine)
-    # Remove the end of the line. Keep the urls.
-    adaptiveFmtLine = re.sub(r'",.*', '', adaptiveFmtLine)
-
-    # Get the normal video formats. Remove the beginning of the line. Keep the urls.
-    urlLine = re.sub(r'.*"url_encoded_fmt_stream_map":"', '', urlLine)
-    # Remove the end of the line. Keep the urls.
-    urlLine = re.sub(r'",.*', '', urlLine)
-
-    # Split the line up into separate video types. These are separated by commas.
-    # Each element of this new list will be for a different video size and format.
-    videos = urlLine.split(r',')
-    adaptiveVideos = adaptiveFmtLine.split(r',')
-
-    # Operate on each video string. # TODO make these two loops one separate function
-    for i in xrange(len(videos)):
-
-        # Convert "\u0026" to "&".
-        videos[i] = str(videos[i]).decode('unicode-escape')
-        #print str(i) + " " + videos[i]
-
-        # The previous decode() step converted '\n' to new lines.
-        # Put this all on one line to make future regex operations easier.
-        videos[i] = re.sub(r'\n', '', videos[i])
-
-        # The data in each video type string is separated by ampersands.
-        # Split by ampersands to make a new list for each element in videos.
-        videos[i] = videos[i].split(r'&')
-
-        # Make a dict with the information found from the previous split().
-        # This data is name/value pairs separated by equals signs.
-        videoDataDict = {}
-        for j in xrange(len(videos[i])):
-            nameValue = videos[i][j].split(r'=')
-            # Add the data to the dict. The first item is the name (key), the second is the value.
-            videoDataDict[nameValue[0]] = nameValue[1]
+            print 'Found the formats of %d videos (%d failed) in %.1f s.' % \
+                (counts['found'], counts['failed'], time.time() - startTime)
 
-        # Replace our list in videos[i] with the new dict.
-        videos[i] = videoDataDict
-
-    # Operate on each video string.
-    for i in xrange(len(adaptiveVideos)):
-
-        # Convert "\u0026" to "&".
-        adaptiveVideos[i] = str(adaptiveVideos[i]).decode('unicode-escape')
-
-        # The previous decode() step converted '\n' to new lines.
-        # Put this all on one line to make future regex operations easier.
-        adaptiveVideos[i] = re.sub(r'\n', '', adaptiveVideos[i])
-
-        # The data in each video type string is separated by ampersands.
-        # Split by ampersands to make a new list for each element in videos.
-        adaptiveVideos[i] = adaptiveVideos[i].split(r'&')
+'''
+Download the videos in a manifest made by --extract. Their watch pages aren't
+needed unless the stream URLs have expired.
+    manifestName - The manifest file, or "-" for stdin.
+'''
+def getVideosFromManifest(manifestName):
+    global manifest
+    manifest = {}
+
+    urls = []
+    manifestFile = sys.stdin if manifestName == '-' else open(manifestName)
+    for lineNum, line in enumerate(manifestFile):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            info = VideoInfo.fromDict(record)
+        except (ValueError, KeyError, TypeError), e:
+            if not args.quiet:
+                print 'WARNING: Skipping line ' + str(lineNum + 1) + ' of the manifest: ' + str(e)
+            continue
+        # Videos without an ID can still be found again in their saved page.
+        if info.videoID is not None:
+            url = 'http://www.youtube.com/watch?v=' + info.videoID.encode('utf-8')
+        else:
+            url = 'file://' + record['file'].encode('utf-8')
+        info.fromCache = True
+        manifest[url] = info
+        urls.append(url)
+    if manifestFile is not sys.stdin:
+        manifestFile.close()
 
-        # Make a dict with the information found from the previous split().
-        # This data is name/value pairs separated by equals signs.
-        adaptiveVideoDataDict = {}
-        for j in xrange(len(adaptiveVideos[i])):
-            nameValue = adaptiveVideos[i][j].split(r'=')
-            # Add the data to the dict. The first item is the name (key), the second is the value.
-            adaptiveVideoDataDict[nameValue[0]] = nameValue[1]
+    for url in urls:
+        queueDownload(url)
 
-        # Replace our list in adaptiveVideos[i] with the new dict.
-        adaptiveVideos[i] = adaptiveVideoDataDict
+'''
+Download the videos queued for --order. The watch page of each one is
+fetched first (several at a time) to find the size of the format that will be
+downloaded, from its clen or from a HEAD request. Then they're downloaded in
+order:
+    shortest - The smallest first, so most files are done early.
+    largest - The biggest first, so with --jobs the long downloads overlap.
+    deadline - The earliest deadline (URL@SECONDS) first. Videos without a
+               deadline go last, and videos with the same one go smallest first.
+Videos whose size can't be found go after the others. The pages that were
+fetched are used for the downloads, unless their URLs expire in the meantime.
+Videos in the archive (--archive) aren't fetched. They count as size 0, so
+they're skipped right away.
+'''
+def downloadScheduled():
+    global manifest
+    if manifest is None:
+        manifest = {}
 
+    startTime = time.time()
+    sizes = {} # URL -> size in bytes, or None.
 
-    # Clean up the values in the dict.
-    for i in xrange(len(videos)):
+    def prefetch(url):
+        if archive is not None and archive.contains(getVideoID(url)):
+            sizes[url] = 0
+            return
+        try:
+            info = getVideoInfo(url, True)
+            if info is not None:
+                info.fromCache = True # Get the page again if its URLs stop working.
+                manifest[url] = info
+                sizes[url] = getDownloadSize(info)
+        except Exception:
+            print '\nERROR: Unexpected error for ' + url
+            traceback.print_exc(file=sys.stdout)
+
+    runWorkers([url for url, deadline in scheduled], prefetch, PREFETCH_THREADS, 'prefetch')
+
+    def getKey(task):
+        url, deadline = task
+        size = sizes.get(url)
+        # sort() keeps the given order for videos that are the same.
+        sizeKey = (size is None, -size if args.order == 'largest' and size is not None else size)
+        if args.order == 'deadline':
+            return (deadline is None, deadline) + sizeKey
+        return sizeKey
+
+    order = sorted(scheduled, key=getKey)
+    del scheduled[:]
+    if not args.quiet:
+        print 'Found the sizes of %d of %d videos in %.1f s. Downloading %s first.' % \
+            (len([size for size in sizes.itervalues() if size is not None]), len(order), \
+            time.time() - startTime, {'shortest': 'the smallest', 'largest': 'the biggest', \
+            'deadline': 'the earliest deadline'}[args.order])
+    for url, deadline in order:
+        if args.debug or args.superDebug:
+            size = sizes.get(url)
+            print '%s: %s MB%s' % (url, '%.1f' % (size / MB) if size is not None else '?', \
+                ', deadline %g s' % deadline if deadline is not None else '')
+        if pool is None:
+            download(url)
+        else:
+            pool.submit(url)
 
-        # Unencode the URL.
-        videos[i]['url'] = urllib.unquote(videos[i]['url'])
+'''
+Download the video at url, and write its metrics with --metrics.
+    url - The URL or video ID of the video to download.
+    returns 'downloaded', 'simulated', 'skipped' (already in --archive) or 'failed'.
+'''
+def download(url):
+    metrics = VideoMetrics(url)
+    try:
+        metrics.success = downloadVideo(url, metrics)
+        numBytes, seconds = metrics.getDownloaded()
+        if metrics.success and seconds:
+            speedEstimate.add(numBytes / seconds)
+        return metrics.getResult()
+    except Exception, e:
+        metrics.error = str(e) or e.__class__.__name__
+        raise
+    finally:
+        if metricsLog is not None:
+            metricsLog.write(metrics.toDict())
 
-        # Unencode the fallback_host. This might not be needed.
-        #videos[i]['fallback_host'] = urllib.unquote(videos[i]['fallback_host'])
+'''
+Download the video at url. See download().
+    metrics - The VideoMetrics to record how long everything took in.
+'''
+def downloadVideo(url, metrics):
 
-        # Unencode the type data.
-        videos[i]['type'] = urllib.unquote(videos[i]['type'])
+    if args.debug or args.superDebug:
+        print "URL: " + url
 
-        # There may be extra stuff in the type data after a semicolon (and maybe an ampersand). Example:
-        # video/webm;+codecs="vp8.0,+vorbis"
-        # Get rid of this extra data. (Leave video/webm or whatever).
-        videos[i]['type'] = re.sub(r'[;&].*', '', videos[i]['type'])
+    # Skip videos that are already in the archive without touching the network.
+    if archive is not None and archive.contains(getVideoID(url)):
+        if not args.quiet:
+            print 'Already downloaded: ' + url
+        metrics.videoID = getVideoID(url)
+        metrics.skipped = True
+        return True
+
+    info = getVideoInfo(url, True, metrics)
+    if info is None:
+        return False
+    metrics.videoID = info.videoID
+
+    # Saved pages (--files) only have their video ID on the page.
+    if archive is not None and archive.contains(info.videoID):
+        if not args.quiet:
+            print 'Already downloaded: ' + url
+        metrics.skipped = True
+        return True
 
-    # Clean up the values in the dict.
-    for i in xrange(len(adaptiveVideos)):
+    startTime = time.time() # Choosing the format starts here.
 
-        # Unencode the URL.
-        adaptiveVideos[i]['url'] = urllib.unquote(adaptiveVideos[i]['url'])
+    videoTitle = re.sub(r'\/', r'_', info.title) # Replace forward slashes with underscores (because Linux).
 
-        # Unencode the type data.
-        adaptiveVideos[i]['type'] = urllib.unquote(adaptiveVideos[i]['type'])
+    if args.appendId and info.videoID is not None:
+        videoTitle += ' - YouTube ' + info.videoID
 
-        # There may be extra stuff in the type data after a semicolon (and maybe an ampersand). Example:
-        # video/webm;+codecs="vp8.0,+vorbis"
-        # Get rid of this extra data. (Leave video/webm or whatever).
-        adaptiveVideos[i]['type'] = re.sub(r'[;&].*', '', adaptiveVideos[i]['type'])
+    fmtListDict = info.fmtList
+    videos = info.videos
+    adaptiveVideos = info.adaptiveVideos
+    fmtListFound = fmtListDict is not None
 
     # Print every element.
     if args.superDebug:
@@ -257,7 +535,7 @@ def download(url):
     numNormalVideos = len(videos)
 
     # If any of these arguments are set, then we skip user input.
-    skipInput = args.maxQuality or args.minQuality or args.maxMP4 or args.minMP4
+    skipInput = args.maxQuality or args.minQuality or args.maxMP4 or args.minMP4 or isBudgetSet()
 
     if (not skipInput) or args.debug or args.superDebug:
         # Print out the options.
@@ -265,27 +543,25 @@ def download(url):
         print ' # :  ID :        TYPE  : QUALITY : DIMENSIONS'
         print '----------------------------------------------'
         for i in xrange(len(videos)):
-            print '%2d : %3s : %12s : %7s : %s' % (1 + i, videos[i]['itag'], \
-                videos[i]['type'], videos[i]['quality'], \
-                
-                fmtListDict[str(videos[i]['itag'])] if fmtListFound else '???')
+            print '%2d : %3s : %12s : %7s : %s' % (1 + i, videos[i].itag, \
+                videos[i].type, videos[i].quality, \
+                fmtListDict.get(videos[i].itag, '???') if fmtListFound else '???')
         print '' # Print a newline.
 
     if (not skipInput) or args.debug or args.superDebug:
-        # Print out the options.
-        # I use the get() function for when a certain key might not exist. It offers a default value.
+        # Print out the options. Values that a format doesn't have are shown as "-".
         print '-------------------------------------------------------------------------'
         print ' # :  ID :        TYPE  :      SIZE : FPS :  BITRATE :     INDEX :   INIT'
         print '-------------------------------------------------------------------------'
         for i in xrange(len(adaptiveVideos)):
             print '%2d : %3s : %12s : %9s : %3s : %8s : %9s : %6s' \
-                % (1 + i + numNormalVideos, adaptiveVideos[i]['itag'], \
-                adaptiveVideos[i]['type'], \
-                adaptiveVideos[i].get('size', '-'), \
-                adaptiveVideos[i].get('fps', '-'), \
-                adaptiveVideos[i]['bitrate'], \
-                adaptiveVideos[i]['index'], \
-                adaptiveVideos[i]['init'])
+                % (1 + i + numNormalVideos, adaptiveVideos[i].itag, \
+                adaptiveVideos[i].type, \
+                adaptiveVideos[i].size or '-', \
+                adaptiveVideos[i].fps or '-', \
+                adaptiveVideos[i].bitrate or '-', \
+                adaptiveVideos[i].index or '-', \
+                adaptiveVideos[i].init or '-')
         print '' # Print a newline.
 
     # Concatenate both lists.
@@ -294,119 +570,2268 @@ def download(url):
     if not skipInput:
         videoNum = getVideoNumInput(len(allFormats))
     else:
-        videoNum = getAutoVideoNum(videos) # TODO make the "highest quality" option check the adaptive formats
+        videoNum = getSelectedVideoNum(info)
 
     if videoNum > len(videos) and args.combine: # The video is from the adaptive formats list.
         # Find audio to dowload.
-        if allFormats[videoNum - 1]['type'].startswith('audio/'):
+        if allFormats[videoNum - 1].type.startswith('audio/'):
             sys.stderr.write('ERROR: Select a video file first and an audio file will be selected for it.\n')
-            return
-        matchinAudioFormat = 'audio/mp4' # Default format.
-        if allFormats[videoNum - 1]['type'] == 'video/webm': matchinAudioFormat = 'audio/webm' # Match webm video with webm audio
-        for i in xrange(len(allFormats)):
-            if allFormats[i]['type'] == matchinAudioFormat:
-                audioNum = i + 1 # The first matching audio. TODO: We should search by highest bitrate. It's not in descending bitrate order for the webm audio for video fhdIYS2gOBU
-        fullAudioUrl = allFormats[audioNum - 1]['url']
+            return False
+        audioNum = getAudioNum(allFormats, videoNum)
+        fullAudioUrl = allFormats[audioNum - 1].url
+
+    # The itag of the file, or "video+audio" for combined formats.
+    formatKey = allFormats[videoNum - 1].itag
+    if videoNum > len(videos) and args.combine:
+        formatKey += '+' + allFormats[audioNum - 1].itag
 
     # Find a good file extension for the file.
-    extension = mimetypes.guess_extension(allFormats[videoNum - 1]['type'], strict=False)
+    extension = mimetypes.guess_extension(allFormats[videoNum - 1].type, strict=False)
 
     if extension is None:
         extension = ".VIDEO"
 
     fileName = videoTitle + extension
 
-    # Check to see if we're about to overwrite something.
-    suffixNum = 1
-    while os.path.exists(fileName) and not args.overwrite:
+    # With --store each video and format is saved once, and linked to its name.
+    storePath = None
+    if store is not None and info.videoID is not None:
+        storePath = store.getPath(info.videoID, formatKey, extension)
+
+    # Check to see if we're about to overwrite something. The name is reserved
+    # so that other downloads, here or in other runs, don't take it too.
+    if not args.overwrite:
+        # A link to the same video in the store can be used as it is.
+        isLinked = lambda name: storePath is not None and store.isLinked(storePath, name)
         if args.promptName: # Ask the user for a file name.
-            print '\nFile name collision: ' + fileName
-            fileName = raw_input('Enter a new file name (without the extension): ') + extension
+            while not getOutputIndex(fileName).claim(fileName, isLinked):
+                print '\nFile name collision: ' + fileName
+                fileName = raw_input('Enter a new file name (without the extension): ') + extension
         else: # not args.promptName
             # Use the same way to deal with file name collisions as wget.
-            fileName = videoTitle + '.' +  str(suffixNum) + extension
-            suffixNum += 1
+            fileName = getOutputIndex(fileName).reserve(videoTitle, extension, isLinked)
 
-    # Add the fallback_host to the url to download.
-    fullUrlDict = allFormats[videoNum - 1]
-    
-    # Download the video with the browser from above (unless we're doing a simulation).
-    if not args.simulate:
+    # The URL of the format to download.
+    fullUrl = allFormats[videoNum - 1].url
+    metrics.addPhase('select', startTime)
+    metrics.itag = formatKey
+
+    '''
+    Download the video to a file.
+    '''
+    def save(fileName):
         if videoNum <= len(videos) or not args.combine: # The video is not from the adaptive formats or we don't want to combine video and audio.
             if args.debug or args.superDebug:
                 print 'Downloading video number: ' + str(videoNum)
                 print 'Downloading video url: ' + fullUrl
             if not args.quiet:
                 print 'Saving file: ' + fileName
-            browser.retrieve(fullUrl, fileName)
+            progress = Progress('Downloading', 1)
+            try:
+                digest = retrieve(allFormats[videoNum - 1], fileName, progress, 0, metrics)
+            finally:
+                progress.finish()
+            if digest is not None:
+                writeHashFile(fileName, digest)
 
         else: # The video is from the adaptive formats list. We have to get the audio and add it to the video.
-            # Make /tmp files to save the video and audio to. Make sure to strip
-            # the newline from the output of mktemp.
-            tempVideo = subprocess.check_output(["mktemp", '-t', \
-                'youtube-get.py_video_XXXXXX'], \
-                stdin=None, stderr=None, shell=False).rstrip('\n')
-            tempAudio = subprocess.check_output(["mktemp", '-t', \
-                'youtube-get.py_audio_XXXXXX'], \
-                stdin=None, stderr=None, shell=False).rstrip('\n')
-
             if args.debug or args.superDebug:
                 print 'Downloading video number: ' + str(videoNum)
                 print 'Downloading video url: ' + fullUrl
-            if not args.quiet:
-                print 'Saving temporary video: ' + tempVideo
-            browser.retrieve(fullUrl, tempVideo)
-
             if not args.quiet: # Show the audio number even without --debug since it's automatically selected and the user won't know what it is otherwise.
                 print 'Downloading audio number: ' + str(audioNum)
             if args.debug or args.superDebug:
                 print 'Downloading audio url: ' + fullAudioUrl
-            if not args.quiet:
-                print 'Saving temporary audio: ' + tempAudio
-            browser.retrieve(fullAudioUrl, tempAudio)
 
+            # Feed the streams straight into ffmpeg if asked to. Use temporary
+            # files if that doesn't work, since some files can't be read in order.
+            if not args.streamMux or \
+               not combineWithPipes(allFormats[videoNum - 1], allFormats[audioNum - 1], fileName, metrics):
+                combineWithTempFiles(allFormats[videoNum - 1], allFormats[audioNum - 1], fileName, metrics)
+
+    # Download the video (unless we're doing a simulation).
+    if not args.simulate:
+        try:
+            if storePath is None:
+                save(fileName)
+            else:
+                store.fetch(storePath, save)
+                store.link(storePath, fileName)
+                if args.hash is not None:
+                    copyHashFile(storePath, fileName)
+        except urllib2.HTTPError, e:
+            # The stream URLs in cached data can stop working before they're supposed to expire.
+            if e.code != 403 or not info.fromCache:
+                raise
             if not args.quiet:
-                print 'Combining files with ffmpeg: ' + fileName
-            ffmpegReturn = subprocess.check_call(["ffmpeg", \
-                '-i', tempVideo, '-i', tempAudio, '-vcodec', 'copy', \
+                print 'The saved data for ' + url + ' is out of date. Getting it again.'
+            if cache is not None and info.videoID is not None:
+                cache.remove(info.videoID)
+            if manifest is not None:
+                manifest.pop(url, None)
+            metrics.retries += 1
+            releaseFileName(fileName)
+            return downloadVideo(url, metrics)
+        finally:
+            releaseFileName(fileName)
+
+        if archive is not None and info.videoID is not None:
+            archive.add(info.videoID, formatKey)
+
+    return True
+
+'''
+Download a video and an audio format to temporary files and combine them with ffmpeg.
+    videoFormat - The Format of the video.
+    audioFormat - The Format of the audio.
+    fileName - The name of the combined file.
+    metrics - The VideoMetrics of the video.
+'''
+def combineWithTempFiles(videoFormat, audioFormat, fileName, metrics):
+    # Save the video and audio next to the final file. The names only
+    # depend on the format, so an interrupted download can be continued.
+    tempVideo = fileName + '.f' + videoFormat.itag
+    tempAudio = fileName + '.f' + audioFormat.itag
+
+    if not args.quiet:
+        print 'Saving temporary video: ' + tempVideo
+        print 'Saving temporary audio: ' + tempAudio
+
+    # The video and audio come from different URLs, so get them at the same time.
+    # Skip either one if an interrupted run already finished it.
+    progress = Progress('Downloading video and audio', 2)
+    functions = []
+    if not isDownloaded(tempVideo, videoFormat):
+        functions.append(lambda: retrieve(videoFormat, tempVideo, progress, 0, metrics))
+    if not isDownloaded(tempAudio, audioFormat):
+        functions.append(lambda: retrieve(audioFormat, tempAudio, progress, 1, metrics))
+    try:
+        runInParallel(functions)
+    finally:
+        progress.finish()
+
+    if not args.quiet:
+        print 'Combining files with ffmpeg: ' + fileName
+    startTime = time.time()
+    # -y since the name was reserved with an empty file.
+    ffmpegReturn = subprocess.check_call(["ffmpeg", '-y', \
+        '-i', tempVideo, '-i', tempAudio, '-vcodec', 'copy', \
+        '-acodec', 'copy', fileName, '-loglevel', 'warning'], \
+        stdin=None, stdout=None, stderr=None, shell=False)
+    metrics.addPhase('mux', startTime)
+
+    if not args.quiet:
+        print 'Removing temporary files.'
+    os.remove(tempVideo)
+    os.remove(tempAudio)
+
+'''
+Combine a video and an audio format with ffmpeg while they download. The
+streams are fed to ffmpeg through named pipes, so nothing but the combined
+file is written to disk and ffmpeg finishes right after the last byte arrives.
+    videoFormat - The Format of the video.
+    audioFormat - The Format of the audio.
+    fileName - The name of the combined file.
+    metrics - The VideoMetrics of the video. The time ffmpeg runs is counted
+              as muxing, even though most of it is spent waiting for the downloads.
+    returns True if it worked, or False if ffmpeg couldn't read the streams
+    this way (for example if it needs to seek in them).
+'''
+def combineWithPipes(videoFormat, audioFormat, fileName, metrics):
+    if not args.quiet:
+        print 'Downloading and combining with ffmpeg: ' + fileName
+
+    tempDir = tempfile.mkdtemp(prefix='youtube-get.py_')
+    try:
+        videoPipe = os.path.join(tempDir, 'video')
+        audioPipe = os.path.join(tempDir, 'audio')
+        os.mkfifo(videoPipe)
+        os.mkfifo(audioPipe)
+
+        startTime = time.time()
+        try:
+            ffmpeg = subprocess.Popen(["ffmpeg", '-y', \
+                '-i', videoPipe, '-i', audioPipe, '-vcodec', 'copy', \
                 '-acodec', 'copy', fileName, '-loglevel', 'warning'], \
                 stdin=None, stdout=None, stderr=None, shell=False)
-            
+        except OSError, e:
+            # ffmpeg isn't there or can't be run. It gets one more chance with temporary files.
             if not args.quiet:
-                print 'Removing temporary files.'
-                os.remove(tempVideo)
-                os.remove(tempAudio)
+                print 'Couldn\'t run ffmpeg (' + str(e) + '). Using temporary files instead.'
+            return False
 
+        progress = Progress('Downloading video and audio', 2)
+
+        wrongSize = [] # Streams that didn't come out the size they should be.
+
+        def feed(fmt, pipeName, streamNum):
+            pipe = openPipe(pipeName, ffmpeg)
+            if pipe is None: # ffmpeg quit before it got to this stream.
+                return
+            try:
+                retrieveToPipe(fmt, pipe, progress, streamNum, metrics)
+            except WrongSize, e:
+                # What ffmpeg got can't be taken back, so start over with temporary files.
+                if not args.quiet:
+                    print str(e)
+                wrongSize.append(fmt)
+            except IOError, e:
+                # ffmpeg stopped reading. Its exit status says if that's a problem.
+                if e.errno != errno.EPIPE:
+                    raise
+            finally:
+                try:
+                    pipe.close()
+                except IOError:
+                    pass
+
+        success = False
+        try:
+            runInParallel([lambda: feed(videoFormat, videoPipe, 0), \
+                           lambda: feed(audioFormat, audioPipe, 1)])
+            success = ffmpeg.wait() == 0 and not wrongSize
+        finally:
+            # If something went wrong, closing the pipes makes ffmpeg stop on its own.
+            ffmpeg.wait()
+            metrics.addPhase('mux', startTime)
+            progress.finish()
+            # Don't leave a half-combined file behind. An empty one keeps the name reserved.
+            if not success and os.path.exists(fileName):
+                if args.overwrite:
+                    os.remove(fileName)
+                else:
+                    open(fileName, 'w').close()
+    finally:
+        shutil.rmtree(tempDir)
+
+    if not success and not args.quiet:
+        if wrongSize:
+            print 'Downloading again with temporary files.'
+        else:
+            print 'ffmpeg couldn\'t combine the streams while downloading. Using temporary files instead.'
+    return success
 
 '''
-Get a list of every video ID in a playlist.
-    playlistURL - The URL of the playlist.
-    returns the list of every video ID in the playlist.
+Open a named pipe for writing without waiting forever if the process that is
+supposed to read it quits first.
+    pipeName - The path of the named pipe.
+    process - The subprocess.Popen that reads it.
+    returns the open pipe, or None if the process quit.
 '''
-def getPlaylistURLs(playlistURL):
+def openPipe(pipeName, process):
+    while True:
+        try:
+            # Opening a pipe normally waits for a reader. This fails right away instead.
+            fd = os.open(pipeName, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError, e:
+            if e.errno != errno.ENXIO: # ENXIO means nothing is reading it yet.
+                raise
+            if process.poll() is not None:
+                return None
+            time.sleep(0.05)
+            continue
+        # Go back to normal writes that wait for the reader.
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+        return os.fdopen(fd, 'wb')
 
-    videos = []
+'''
+Get the title and formats of a video, from the cache (--cache) if possible
+or else from its watch page.
+    url - The URL of the watch page.
+    useCache - False to get the watch page even if the video is in the cache.
+    metrics - The VideoMetrics to record the time it takes in, or None.
+    returns a VideoInfo, or None if there was an error.
+'''
+def getVideoInfo(url, useCache, metrics=None):
+    videoID = getVideoID(url)
+    if manifest is not None and useCache and url in manifest:
+        info = manifest[url]
+        expireTime = info.getExpireTime()
+        if expireTime is None or expireTime - time.time() > CACHE_EXPIRE_MARGIN:
+            if metrics is not None:
+                metrics.cached = True
+            return info
+        if args.debug or args.superDebug:
+            print 'The manifest data for ' + url + ' has expired.'
+    if cache is not None and useCache and videoID is not None:
+        info = cache.get(videoID)
+        if info is not None:
+            if args.debug or args.superDebug:
+                print 'Using cached data for ' + videoID
+            if metrics is not None:
+                metrics.cached = True
+            return info
+
+    try:
+        startTime = time.time()
+        htmlHandle = session.open(url)
+        html = htmlHandle.read()
+        htmlHandle.close()
+        if metrics is not None:
+            metrics.addPhase('pageFetch', startTime)
+            metrics.retries += getattr(htmlHandle, 'retries', 0)
+    except urllib2.HTTPError, e:
+        if not args.quiet:
+            print '\nERROR: HTTP error for ' + url
+            print 'Maybe there\'s a 404 error?\n'
+        return None
+    except urllib2.URLError, e:
+        if not args.quiet:
+            print '\nERROR: urllib2.URLError for ' + url
+            print 'Maybe there\'s a network connectivity problem?\n'
+        return None
+
+    startTime = time.time()
+    info = parseVideoInfo(html, url, videoID)
+    if info is None:
+        return None
+    if metrics is not None:
+        metrics.addPhase('parse', startTime)
+
+    if cache is not None and info.videoID is not None:
+        cache.put(info)
+    return info
+
+'''
+Get the title and formats of a video from its watch page.
+    html - The watch page.
+    url - The URL of the page, for error messages.
+    videoID - The ID of the video, or None to find it on the page.
+    returns a VideoInfo, or None if the page has no video data.
+'''
+def parseVideoInfo(html, url, videoID):
+    videoTitle = getPageTitle(html) # Get the title of the video.
+    videoTitle = re.sub(' - YouTube$', '', videoTitle) # Get rid of the "- YouTube" bit at the end.
 
-    browser = mechanize.Browser()
-    #browser.set_all_readonly(False) # allow everything to be written to
-    browser.set_handle_robots(False) # no robots
-    browser.set_handle_refresh(False) # can sometimes hang without this
-    browser.addheaders = [('User-agent', 'Mozilla/5.0 (X11; U; Linux i686; en-US; rv:1.9.0.1) Gecko/2008071615 Fedora/3.0.1-1.fc9 Firefox/3.0.1')]
-    htmlHandle = browser.open(playlistURL)
+    # Get the format data from the page.
+    streamMaps = parseWatchPage(html)
+    if streamMaps is None:
+        if not args.quiet:
+            print '\nERROR 113: No video data found for ' + url + '\n'
+        return None
+    fmtListDict, videos, adaptiveVideos = streamMaps
 
-    for currentLine in htmlHandle:
-        # Find a line with a video ID. They have "data-video-ids=" in them.
-        match = re.search(r'data-video-ids="([^"]+)"', currentLine)
+    if fmtListDict is None and not args.quiet:
+        print '\nERROR NUMBER 112: No fmt_list data found for ' + url + '\n'
+
+    # Saved pages (--files) don't have the ID in their URL, but the page has it.
+    if videoID is None:
+        match = VIDEO_ID_PATTERN.search(html)
         if match:
-            videos.append(match.group(1)) # This group is the video ID.
+            videoID = match.group(1)
+
+    return VideoInfo(videoID, videoTitle, fmtListDict, videos, adaptiveVideos)
+
+'''
+Get the video ID from the URL of a watch page.
+    url - The URL.
+    returns the ID, or None if the URL doesn't have one.
+'''
+def getVideoID(url):
+    match = re.search(r'[\?&]v=([^&#]+)', url) or re.search(r'youtu\.be/([^\?&#/]+)', url)
+    if match:
+        return match.group(1)
+    return None
+
+'''
+Find every video ID in a playlist. Long playlists are split into pages, and
+each page after the first is loaded with the "Load more" URL on the page
+before it. The IDs are generated as they're found, so the videos can start
+downloading before the rest of the playlist is loaded. The next page isn't
+loaded until the IDs from the page before it have been used.
+    playlistURL - The URL of the playlist.
+    returns a generator of the video IDs in the playlist, without repeats.
+'''
+def getPlaylistVideoIDs(playlistURL):
+
+    foundIDs = set()
+    loadedURLs = set()
+    pageURL = playlistURL
+
+    while pageURL is not None and pageURL not in loadedURLs:
+        loadedURLs.add(pageURL)
+
+        # Read the whole page first so the connection is free again before
+        # any of its videos are downloaded.
+        try:
+            response = session.open(pageURL)
+            page = response.read()
+            response.close()
+        except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+            if pageURL == playlistURL:
+                raise
+            # Keep the videos that were already found.
+            if not args.quiet:
+                print 'WARNING: Couldn\'t load the rest of the playlist at:\n' + playlistURL + '\n' + str(e)
+            break
+
+        # The pages after the first are JSON with the HTML of the videos and
+        # of the next "Load more" button.
+        if page.lstrip().startswith('{'):
+            try:
+                data = json.loads(page)
+            except ValueError:
+                data = {}
+            page = data.get('content_html', '').encode('utf-8')
+            moreHTML = data.get('load_more_widget_html', '').encode('utf-8')
+        else:
+            moreHTML = page
 
-    htmlHandle.close()
+        for match in PLAYLIST_VIDEO_PATTERN.finditer(page):
+            videoID = match.group(1)
+            if videoID not in foundIDs:
+                foundIDs.add(videoID)
+                yield videoID
+
+        match = LOAD_MORE_PATTERN.search(moreHTML)
+        if match:
+            moreURL = HTMLParser.HTMLParser().unescape(match.group(1)) # Convert "&amp;" to "&".
+            pageURL = urlparse.urljoin(pageURL, moreURL.encode('utf-8'))
+        else:
+            pageURL = None
 
     # No videos were found.
-    if len(videos) == 0 and not args.quiet:
+    if len(foundIDs) == 0 and not args.quiet:
         print 'WARNING: No videos found in playlist at:\n' + playlistURL
 
-    return videos
+'''
+Find the format data in a watch page. Everything is found in one pass over
+the page.
+    html - The watch page.
+    returns (fmtListDict, videos, adaptiveVideos), or None if there's no
+    video data on the page. fmtListDict maps each itag to its dimensions, or
+    is None if the page doesn't have them. videos is the list of Formats with
+    both video and audio, and adaptiveVideos is the list of Formats that only
+    have one or the other.
+'''
+def parseWatchPage(html):
+    found = {}
+    for match in STREAM_MAP_PATTERN.finditer(html):
+        # The same data is repeated a few times on the page. Keep the first.
+        if match.group(1) not in found:
+            found[match.group(1)] = match.group(2)
+            if len(found) == 3:
+                break
+
+    if 'url_encoded_fmt_stream_map' not in found:
+        return None
+
+    fmtListDict = None
+    if 'fmt_list' in found:
+        # The formats are separated by commas, and each one looks like 43/640x360/99/0/0.
+        fmtListDict = {}
+        for item in unescapeJSON(found['fmt_list']).split(','):
+            parts = item.split('/')
+            if len(parts) > 1:
+                fmtListDict[parts[0]] = parts[1]
+
+    videos = parseStreamMap(found['url_encoded_fmt_stream_map'])
+    # The adaptive_fmts data has the video and audio split up.
+    adaptiveVideos = parseStreamMap(found.get('adaptive_fmts', ''))
+    return fmtListDict, videos, adaptiveVideos
+
+'''
+Decode a string from the JavaScript on a watch page.
+    value - The string without its quotes.
+    returns the decoded string.
+'''
+def unescapeJSON(value):
+    # "&" and "\/" are nearly the only escapes used, so handle them quickly.
+    value = value.replace('\\u0026', '&').replace('\\/', '/')
+    if '\\' in value:
+        value = json.loads('"' + value + '"').encode('utf-8')
+    return value.replace('\n', '')
+
+'''
+Split a stream map into Formats.
+    streamMap - The url_encoded_fmt_stream_map or adaptive_fmts value from a watch page.
+    returns a list of Formats.
+'''
+def parseStreamMap(streamMap):
+    formats = []
+    # Each format is separated by a comma, and its name=value pairs by ampersands.
+    for formatString in unescapeJSON(streamMap).split(','):
+        if not formatString:
+            continue
+        values = {}
+        for pair in formatString.split('&'):
+            name, equals, value = pair.partition('=') # Only the first "=" separates the name.
+            values[name] = value
+
+        clen = values.get('clen', '')
+        bitrate = values.get('bitrate', '')
+        formats.append(Format({ \
+            'itag': values.get('itag'), \
+            # There may be extra stuff in the type data after a semicolon. Example:
+            # video/webm;+codecs="vp8.0,+vorbis"
+            # Get rid of this extra data. (Leave video/webm or whatever).
+            'type': urllib.unquote(values.get('type', '')).partition(';')[0], \
+            'quality': values.get('quality'), \
+            'size': values.get('size'), \
+            'fps': values.get('fps'), \
+            'bitrate': int(bitrate) if bitrate.isdigit() else None, \
+            'clen': int(clen) if clen.isdigit() else None, \
+            'url': urllib.unquote(values.get('url', '')), \
+            'fallbackHost': urllib.unquote(values['fallback_host']) if 'fallback_host' in values else None, \
+            'index': values.get('index'), \
+            'init': values.get('init')}))
+    return formats
+
+'''
+One format of a video from a stream map. Values that the stream map doesn't
+have are None. Sizes (clen) and bitrates are ints.
+'''
+class Format(object):
+
+    # Videos have a few dozen formats, so don't give each one a dict.
+    __slots__ = ('itag', 'type', 'quality', 'size', 'fps', 'bitrate', 'clen', \
+        'url', 'fallbackHost', 'index', 'init')
+
+    '''
+        values - A dict of the values. Missing ones are None.
+    '''
+    def __init__(self, values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+    '''
+        returns the values as a dict.
+    '''
+    def toDict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __repr__(self):
+        return 'Format(' + repr(self.toDict()) + ')'
+
+'''
+What is known about a video from its watch page.
+'''
+class VideoInfo(object):
+
+    '''
+        videoID - The ID of the video, or None if it isn't known.
+        title - The title of the video.
+        fmtList - A dict of the dimensions of each itag, or None if the page doesn't have them.
+        videos - The list of Formats with both video and audio.
+        adaptiveVideos - The list of Formats with only video or only audio.
+    '''
+    def __init__(self, videoID, title, fmtList, videos, adaptiveVideos):
+        self.videoID = videoID
+        self.title = title
+        self.fmtList = fmtList
+        self.videos = videos
+        self.adaptiveVideos = adaptiveVideos
+        self.fromCache = False # True if this came from the cache or --manifest instead of the watch page.
+
+    '''
+        returns the info as a dict that can be saved as JSON.
+    '''
+    def toDict(self):
+        return {'videoID': self.videoID, 'title': self.title, 'fmtList': self.fmtList, \
+            'videos': [fmt.toDict() for fmt in self.videos], \
+            'adaptiveVideos': [fmt.toDict() for fmt in self.adaptiveVideos]}
+
+    '''
+    Make a VideoInfo from a dict made by toDict().
+    '''
+    @staticmethod
+    def fromDict(values):
+        # JSON gives back unicode, but titles are UTF-8 bytes like getPageTitle() returns.
+        return VideoInfo(values['videoID'], values['title'].encode('utf-8'), values['fmtList'], \
+            [formatFromJSON(fmtValues) for fmtValues in values['videos']], \
+            [formatFromJSON(fmtValues) for fmtValues in values['adaptiveVideos']])
+
+    '''
+    Find when the first of the stream URLs stops working. Each URL has an
+    "expire" parameter with the time.
+        returns the time in seconds since the epoch, or None if no URL says.
+    '''
+    def getExpireTime(self):
+        expireTimes = []
+        for fmt in self.videos + self.adaptiveVideos:
+            expire = urlparse.parse_qs(urlparse.urlsplit(fmt.url).query).get('expire')
+            if expire and expire[0].isdigit():
+                expireTimes.append(int(expire[0]))
+        return min(expireTimes) if expireTimes else None
+
+'''
+Make a Format from a dict that was read from JSON. JSON strings come back as
+unicode, but the rest of the program uses plain strings for format data.
+'''
+def formatFromJSON(values):
+    for name, value in values.items():
+        if isinstance(value, unicode):
+            values[name] = value.encode('utf-8')
+    return Format(values)
+
+'''
+A cache of video data (VideoInfo) on disk, so watch pages don't have to be
+downloaded again for videos that were just seen, for example with --simulate
+or when a batch is run again after a failure (--cache). Each video is one
+JSON file named after its ID. Entries are used until they're older than the
+TTL or their stream URLs are about to expire. When there are too many, the
+least recently used ones are removed.
+'''
+class MetadataCache(object):
+
+    '''
+        directory - Where to keep the cache. It's made if it doesn't exist.
+        ttl - How many seconds an entry can be used.
+        maxEntries - The most videos to keep.
+    '''
+    def __init__(self, directory, ttl, maxEntries):
+        self.directory = directory
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def getFileName(self, videoID):
+        # Video IDs only use letters, numbers, "-" and "_", but don't trust them.
+        return os.path.join(self.directory, re.sub(r'[^\w-]', '_', videoID) + '.json')
+
+    '''
+    Look up a video.
+        returns its VideoInfo, or None if it isn't in the cache or the entry
+        is too old to use.
+    '''
+    def get(self, videoID):
+        fileName = self.getFileName(videoID)
+        try:
+            with open(fileName) as cacheFile:
+                entry = json.load(cacheFile)
+            info = VideoInfo.fromDict(entry['info'])
+        except (IOError, ValueError, KeyError):
+            return None
+
+        now = time.time()
+        expireTime = entry.get('expire')
+        if now - entry.get('saved', 0) > self.ttl or \
+           (expireTime is not None and now > expireTime - CACHE_EXPIRE_MARGIN):
+            self.remove(videoID)
+            return None
+
+        # The modification time is when the entry was last used.
+        try:
+            os.utime(fileName, None)
+        except OSError:
+            pass
+        info.fromCache = True
+        return info
+
+    '''
+    Add a video to the cache.
+    '''
+    def put(self, info):
+        entry = {'saved': time.time(), 'expire': info.getExpireTime(), 'info': info.toDict()}
+        fileName = self.getFileName(info.videoID)
+        # Write a new file and rename it so the entry is never half written.
+        tempName = '%s.%d.%s.tmp' % (fileName, os.getpid(), threading.current_thread().name)
+        with open(tempName, 'w') as cacheFile:
+            json.dump(entry, cacheFile)
+        os.rename(tempName, fileName)
+        self.evict()
+
+    '''
+    Remove a video from the cache.
+    '''
+    def remove(self, videoID):
+        try:
+            os.remove(self.getFileName(videoID))
+        except OSError:
+            pass
+
+    '''
+    Remove the least recently used entries if there are too many.
+    '''
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                fileName = os.path.join(self.directory, name)
+                try:
+                    entries.append((os.path.getmtime(fileName), fileName))
+                except OSError: # Another thread removed it.
+                    pass
+        if len(entries) <= self.maxEntries:
+            return
+        entries.sort()
+        for lastUsed, fileName in entries[:len(entries) - self.maxEntries]:
+            try:
+                os.remove(fileName)
+            except OSError:
+                pass
+
+'''
+A record of the videos that have been downloaded (--archive), so running the
+same playlists again only downloads new videos. The file has one line for
+each download: the video ID and the itag of the format, separated by a space.
+It's read once at the start and a line is added after each download.
+'''
+class DownloadArchive(object):
+
+    '''
+        fileName - The archive file. It's made if it doesn't exist.
+    '''
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.entries = set() # (video ID, itag) of every download.
+        self.videoIDs = set()
+        self.lock = threading.Lock()
+
+        if os.path.exists(fileName):
+            with open(fileName) as archiveFile:
+                for line in archiveFile:
+                    parts = line.split()
+                    if len(parts) == 2:
+                        self.entries.add((parts[0], parts[1]))
+                        self.videoIDs.add(parts[0])
+
+    '''
+        returns True if any format of the video has been downloaded.
+    '''
+    def contains(self, videoID):
+        return videoID in self.videoIDs
+
+    '''
+    Record a finished download.
+        videoID - The ID of the video.
+        itag - The itag of the format, or "video+audio" for combined formats.
+    '''
+    def add(self, videoID, itag):
+        with self.lock:
+            if (videoID, itag) in self.entries:
+                return
+            # One write to a file opened for appending, so the line can't be
+            # split up or mixed with another line, even by another process.
+            fd = os.open(self.fileName, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+            try:
+                os.write(fd, videoID + ' ' + itag + '\n')
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.entries.add((videoID, itag))
+            self.videoIDs.add(videoID)
+
+'''
+A store of downloaded files, keyed by video ID and format (--store). Each one
+is saved as DIR/ID/ITAG.EXT (or VIDEO+AUDIO.EXT for combined formats) and
+the file with the title of the video is a hard link to it, so a video that is
+in several playlists, or is downloaded again in a later run, is only
+downloaded once. Downloads of the same file at the same time are done once:
+threads of this run wait for each other, and other runs wait on a lock file.
+'''
+class ContentStore(object):
+
+    '''
+        directory - Where to keep the files. It's made if it doesn't exist.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.pending = {} # Path -> threading.Event, set when the download of the path is over.
+        self.lock = threading.Lock()
+
+    '''
+        returns the path of a video in the store.
+    '''
+    def getPath(self, videoID, formatKey, extension):
+        return os.path.join(self.directory, videoID, formatKey + extension)
+
+    '''
+        returns True if fileName is a link to the stored file at path.
+    '''
+    def isLinked(self, path, fileName):
+        return os.path.exists(path) and os.path.exists(fileName) and os.path.samefile(path, fileName)
+
+    '''
+    Make sure a file is in the store, downloading it if it isn't.
+        path - The path from getPath().
+        save - The function that downloads the file. It gets the path to save to.
+    '''
+    def fetch(self, path, save):
+        while True:
+            with self.lock:
+                if os.path.exists(path):
+                    return
+                event = self.pending.get(path)
+                if event is None: # Nobody else is downloading it.
+                    event = threading.Event()
+                    self.pending[path] = event
+                    break
+            if not args.quiet:
+                print 'Waiting for another download of the same video: ' + path
+            waitForEvent(event)
+            # If that download failed, try again here.
+
+        try:
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            # Another run might be downloading the same file.
+            with open(path + '.lock', 'w') as lockFile:
+                fcntl.flock(lockFile, fcntl.LOCK_EX)
+                if not os.path.exists(path):
+                    save(path)
+        finally:
+            with self.lock:
+                del self.pending[path]
+            event.set()
+
+    '''
+    Give a stored file another name. Hard links are used when possible, so
+    the file doesn't take up any more space. Otherwise (for example on another
+    file system) it's copied.
+        path - The stored file.
+        fileName - The new name.
+    '''
+    def link(self, path, fileName):
+        if os.path.exists(fileName):
+            if os.path.samefile(path, fileName):
+                return
+            os.remove(fileName) # The empty file that reserved the name, or with --overwrite.
+        if not args.quiet:
+            print 'Linking ' + fileName + ' to ' + path
+        try:
+            os.link(path, fileName)
+        except OSError, e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP):
+                raise
+            shutil.copyfile(path, fileName)
+
+'''
+The names of the files in an output directory, so that name collisions can be
+resolved without checking the disk for every name. The directory is only read
+once. Names are reserved by creating an empty file with O_EXCL, which the
+download replaces when it's done, so two downloads never get the same name,
+even in different runs. The empty file is locked (flock) until the download
+is over. If a run is interrupted, the next one continues the download under
+the same name.
+'''
+class OutputIndex(object):
+
+    '''
+        directory - The directory, or '' for the current one.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.names = set() # The names of the files in the directory.
+        self.highest = {} # (title, extension) -> the highest number used in title.N.extension.
+        self.resumable = set() # Names that have an interrupted download saved next to them.
+        self.reserved = {} # Name -> the open, locked file that reserves it.
+        for name in os.listdir(directory or '.'):
+            self.add(name)
+            downloadName = self.getDownloadName(name)
+            if downloadName is not None:
+                self.resumable.add(downloadName)
+
+    '''
+    Count a name as taken. The lock must be held (or not needed yet).
+    '''
+    def add(self, name):
+        self.names.add(name)
+        match = re.match(r'(.*)\.(\d+)(\.[^.]*)$', name)
+        if match:
+            key = (match.group(1), match.group(3))
+            self.highest[key] = max(self.highest.get(key, 0), int(match.group(2)))
+
+    '''
+    Find which download a file belongs to if it's a partly downloaded file
+    (NAME.part.json) or one of the temporary files of --combine (NAME.fITAG).
+        returns NAME, or None if it isn't one of those.
+    '''
+    def getDownloadName(self, name):
+        isPart = name.endswith('.part.json')
+        if isPart:
+            name = name[:-len('.part.json')]
+        match = re.match(r'(.+)\.f\d+$', name)
+        if match:
+            return match.group(1)
+        return name if isPart else None
+
+    '''
+    Reserve title + extension, or the first title.N + extension after the
+    highest N in the directory if it's taken.
+        isUsable - A function that says if an existing file can be used as it is.
+        returns the name with the directory.
+    '''
+    def reserve(self, title, extension, isUsable):
+        name = title + extension
+        with self.lock:
+            while not self.claimName(name, isUsable):
+                key = (title, extension)
+                self.highest[key] = self.highest.get(key, 0) + 1
+                name = title + '.' + str(self.highest[key]) + extension
+        return os.path.join(self.directory, name)
+
+    '''
+    Reserve a name chosen by the user (--prompt-name).
+        fileName - The name with the directory.
+        returns True if it was free (or usable), or False if it's taken.
+    '''
+    def claim(self, fileName, isUsable):
+        with self.lock:
+            return self.claimName(os.path.basename(fileName), isUsable)
+
+    '''
+    Reserve a name. The lock must be held. See claim().
+    '''
+    def claimName(self, name, isUsable):
+        if name in self.reserved: # Another download here has it.
+            return False
+        path = os.path.join(self.directory, name)
+        if name in self.names:
+            if isUsable(path):
+                return True
+            # An interrupted download can be continued, unless another run is doing that.
+            if name not in self.resumable or args.simulate:
+                return False
+            try:
+                fd = os.open(path, os.O_WRONLY)
+            except OSError:
+                return False
+            if os.fstat(fd).st_size > 0: # It was finished after all.
+                os.close(fd)
+                return False
+        elif args.simulate: # Nothing is saved, so there's nothing to reserve.
+            return True
+        else:
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+                self.add(name) # Another run made it after the directory was read.
+                return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(fd)
+            self.add(name)
+            return False
+        self.add(name)
+        self.reserved[name] = fd
+        return True
+
+    '''
+    Give up the reservation of a name once its download is over. If nothing
+    was downloaded to it, the empty file is deleted, unless there's a partly
+    downloaded file to continue later.
+        fileName - The name with the directory.
+    '''
+    def release(self, fileName):
+        name = os.path.basename(fileName)
+        with self.lock:
+            fd = self.reserved.pop(name, None)
+            if fd is None:
+                return
+            try:
+                if os.path.exists(fileName) and os.path.getsize(fileName) == 0:
+                    if any(self.getDownloadName(other) == name for other in os.listdir(self.directory or '.')):
+                        self.resumable.add(name)
+                    else:
+                        os.remove(fileName)
+                        self.names.discard(name)
+            finally:
+                os.close(fd)
+
+'''
+Get the OutputIndex of the directory a file goes in, reading the directory the
+first time.
+'''
+def getOutputIndex(fileName):
+    directory = os.path.dirname(fileName)
+    key = os.path.abspath(directory or '.')
+    with outputIndexLock:
+        if key not in outputIndexes:
+            outputIndexes[key] = OutputIndex(directory)
+        return outputIndexes[key]
+
+'''
+Give up the name reserved for a download. See OutputIndex.release().
+'''
+def releaseFileName(fileName):
+    if not args.overwrite and not args.simulate:
+        getOutputIndex(fileName).release(fileName)
+
+'''
+Get the title of a web page.
+    html - The page.
+    returns the title as UTF-8 bytes, or an empty string if there isn't one.
+'''
+def getPageTitle(html):
+    match = re.search(r'<title[^>]*>(.*?)</title>', html, re.IGNORECASE | re.DOTALL)
+    if not match:
+        return ''
+    title = match.group(1).decode('utf-8', 'replace')
+    title = HTMLParser.HTMLParser().unescape(title) # Convert things like "&amp;" to "&".
+    # File names and output are byte strings everywhere else.
+    return re.sub(r'\s+', ' ', title).strip().encode('utf-8')
+
+'''
+Open a URL to download it, optionally only a range of bytes.
+    url - The URL to open.
+    start - The first byte to get.
+    end - The last byte to get, or None to get everything after start.
+    method - The HTTP method to use. The default is GET.
+    returns the response.
+'''
+def openStream(url, start=0, end=None, method='GET'):
+    headers = {}
+    if start > 0 or end is not None:
+        headers['Range'] = 'bytes=%d-%s' % (start, '' if end is None else str(end))
+    return session.open(url, headers, method)
+
+'''
+The connections used for every web page and download. Connections are kept
+open after a request and reused by the next request to the same server, so
+most requests don't need a new TCP connection and TLS handshake. Like
+urllib2, it uses the proxies in http_proxy/https_proxy (and no_proxy) and
+keeps the cookies servers send. The session can be used by several threads
+at once.
+'''
+class Session(object):
+
+    '''
+        poolSize - The most idle connections to keep open to each server.
+        keepAlive - How many seconds an idle connection is kept open. 0 means
+                    a new connection is used for every request.
+    '''
+    def __init__(self, poolSize, keepAlive):
+        self.poolSize = poolSize
+        self.keepAlive = keepAlive
+        self.idle = {} # (scheme, host, port) -> list of (connection, time it was last used).
+        self.lock = threading.Lock()
+        self.proxies = urllib.getproxies() # Scheme -> proxy URL.
+        self.cookies = cookielib.CookieJar()
+
+    '''
+    Open a URL, following redirects.
+        url - The URL to open. file:// URLs work too.
+        headers - A dict of extra headers to send.
+        method - The HTTP method to use.
+        returns a Response.
+    Raises urllib2.HTTPError for HTTP errors and urllib2.URLError for network errors.
+    '''
+    def open(self, url, headers={}, method='GET'):
+        if url.startswith('file:'):
+            return urllib2.urlopen(url)
+
+        for i in xrange(MAX_REDIRECTS + 1):
+            response = self.request(url, headers, method)
+            location = response.info().getheader('Location')
+            if response.code not in (301, 302, 303, 307, 308) or location is None:
+                break
+            # Read the rest of the redirect so the connection can be reused.
+            response.read()
+            response.close()
+            url = urlparse.urljoin(url, location)
+        else:
+            raise urllib2.URLError('Too many redirects for ' + url)
+
+        if response.code >= 400:
+            response.read()
+            response.close()
+            raise urllib2.HTTPError(url, response.code, response.reason, response.info(), None)
+        return response
+
+    '''
+    Make one request.
+        See open() for the arguments.
+        returns a Response.
+    '''
+    def request(self, url, headers, method):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise urllib2.URLError('Unsupported URL: ' + url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        allHeaders = {'User-Agent': USER_AGENT, 'Connection': 'keep-alive' if self.keepAlive > 0 else 'close'}
+        allHeaders.update(headers)
+        cookieRequest = urllib2.Request(url)
+        self.cookies.add_cookie_header(cookieRequest)
+        allHeaders.update(cookieRequest.unredirected_hdrs)
+
+        proxy = self.getProxy(key)
+        if proxy is not None and parts.scheme == 'http':
+            # An HTTP proxy is sent the whole URL.
+            path = urlparse.urlunsplit((parts.scheme, parts.netloc, path, '', ''))
+            if proxy[2] is not None:
+                allHeaders['Proxy-Authorization'] = proxy[2]
+
+        connection, reused = self.getConnection(key, proxy)
+        try:
+            response = self.send(connection, method, path, allHeaders)
+        except (httplib.HTTPException, socket.error), e:
+            if not reused:
+                raise urllib2.URLError(e)
+            # The server may have closed a connection that sat idle. Try once more on a new one.
+            connection, reused = self.getConnection(key, proxy, False)
+            try:
+                response = self.send(connection, method, path, allHeaders)
+            except (httplib.HTTPException, socket.error), e:
+                raise urllib2.URLError(e)
+            response = Response(self, key, connection, response, url, 1)
+        else:
+            response = Response(self, key, connection, response, url, 0)
+        self.cookies.extract_cookies(response, cookieRequest)
+        return response
+
+    '''
+    Send a request on a connection, and close the connection if it fails.
+        returns the httplib response.
+    '''
+    def send(self, connection, method, path, headers):
+        try:
+            connection.request(method, path, headers=headers)
+            return connection.getresponse()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            raise
+
+    '''
+    Find the proxy to use for a server, from the environment like urllib2 does.
+        key - (scheme, host, port) of the server.
+        returns (proxy host, proxy port, Proxy-Authorization header or None), or None for no proxy.
+    '''
+    def getProxy(self, key):
+        scheme, host, port = key
+        if scheme not in self.proxies or urllib.proxy_bypass(host):
+            return None
+        proxyURL = self.proxies[scheme]
+        if '://' not in proxyURL:
+            proxyURL = 'http://' + proxyURL
+        proxyParts = urlparse.urlsplit(proxyURL)
+        authorization = None
+        if proxyParts.username is not None:
+            credentials = urllib.unquote(proxyParts.username) + ':' + urllib.unquote(proxyParts.password or '')
+            authorization = 'Basic ' + credentials.encode('base64').replace('\n', '')
+        return proxyParts.hostname, proxyParts.port or 8080, authorization
+
+    '''
+    Get a connection to a server, reusing an idle one if possible.
+        key - (scheme, host, port) of the server.
+        proxy - What getProxy() returned for the server.
+        reuse - False to always make a new connection.
+        returns (connection, True if it was reused).
+    '''
+    def getConnection(self, key, proxy, reuse=True):
+        with self.lock:
+            connections = self.idle.get(key, [])
+            while reuse and connections:
+                connection, lastUsed = connections.pop()
+                if time.time() - lastUsed < self.keepAlive:
+                    return connection, True
+                connection.close()
+
+        scheme, host, port = key
+        if proxy is None:
+            connectionClass = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+            return connectionClass(host, port, timeout=SOCKET_TIMEOUT), False
+
+        proxyHost, proxyPort, authorization = proxy
+        if scheme == 'http':
+            return httplib.HTTPConnection(proxyHost, proxyPort, timeout=SOCKET_TIMEOUT), False
+        # HTTPS goes through a CONNECT tunnel, so the proxy can't see it.
+        connection = httplib.HTTPSConnection(proxyHost, proxyPort, timeout=SOCKET_TIMEOUT)
+        connection.set_tunnel(host, port, {'Proxy-Authorization': authorization} if authorization else None)
+        return connection, False
+
+    '''
+    Put a connection back in the pool after its response was read, or close
+    it if the pool is full.
+    '''
+    def releaseConnection(self, key, connection):
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if self.keepAlive > 0 and len(connections) < self.poolSize:
+                connections.append((connection, time.time()))
+                return
+        connection.close()
+
+'''
+The response to a Session request. It works like a urllib2 response. The
+connection goes back to the session when the response is closed, if all of
+it was read.
+'''
+class Response(object):
+
+    def __init__(self, session, key, connection, response, url, retries):
+        self.session = session
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.url = url
+        self.retries = retries # How many times the request was made again on a new connection.
+        self.code = response.status
+        self.reason = response.reason
+
+    def info(self):
+        return self.response.msg
+
+    def read(self, size=None):
+        try:
+            return self.response.read(size)
+        except (httplib.HTTPException, socket.error), e:
+            raise urllib2.URLError(e)
+
+    def close(self):
+        if self.connection is None: # Already closed.
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.session.releaseConnection(self.key, self.connection)
+        else: # The server closes it, or the rest of the response wasn't read.
+            self.connection.close()
+        self.connection = None
+
+'''
+Write the hash of a downloaded file (--hash) next to it, in the format of
+sha256sum and similar tools, so it can be checked later with "sha256sum -c".
+    fileName - The downloaded file. The hash goes in fileName.ALGORITHM.
+    digest - The hash in hex.
+'''
+def writeHashFile(fileName, digest):
+    with open(fileName + '.' + args.hash, 'w') as hashFile:
+        hashFile.write(digest + '  ' + os.path.basename(fileName) + '\n')
+
+'''
+Write the hash of a file in the store (--store) next to the file linked to it.
+Nothing is written if the stored file doesn't have one.
+'''
+def copyHashFile(storePath, fileName):
+    try:
+        with open(storePath + '.' + args.hash) as hashFile:
+            digest = hashFile.read().split()[0]
+    except (IOError, IndexError):
+        return
+    writeHashFile(fileName, digest)
+
+'''
+Check if a format was already completely downloaded to fileName.
+    fmt - The Format.
+    returns True if fileName exists and is the size given by clen.
+'''
+def isDownloaded(fileName, fmt):
+    return fmt.clen is not None and os.path.exists(fileName) and \
+        os.path.getsize(fileName) == fmt.clen
+
+'''
+Ask the server how big the file at url is with a HEAD request.
+    returns the size in bytes, or None if the server doesn't say.
+'''
+def getRemoteSize(url):
+    try:
+        response = openStream(url, method='HEAD')
+    except (urllib2.HTTPError, urllib2.URLError):
+        return None
+    length = response.info().getheader('Content-Length')
+    response.close()
+    if length is not None and length.isdigit():
+        return int(length)
+    return None
+
+'''
+Run functions in threads at the same time and wait for all of them to finish.
+Any error from one of them is raised again once they are all done.
+    functions - A list of functions to call with no arguments.
+'''
+def runInParallel(functions):
+    errors = []
+
+    def run(function):
+        try:
+            function()
+        except Exception:
+            errors.append(sys.exc_info())
+
+    threads = []
+    for function in functions:
+        thread = threading.Thread(target=run, args=(function,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    waitForThreads(threads)
+
+    if errors:
+        errorType, error, errorTraceback = errors[0]
+        raise errorType, error, errorTraceback
+
+'''
+Call a function for each item in several threads at the same time, and wait
+until it's done for all of them. Errors must be handled by the function.
+    items - The items. This can be a generator, which is read as the threads
+            are ready for more, so it doesn't get far ahead of them.
+    function - The function to call with each item.
+    numWorkers - How many threads to use.
+    name - The name of the threads, for debugging.
+'''
+def runWorkers(items, function, numWorkers, name):
+    tasks = Queue.Queue(2 * numWorkers)
+
+    def work():
+        while True:
+            item = tasks.get()
+            if item is None or stopping.is_set(): # Everything was handed out, or Ctrl-C.
+                return
+            function(item)
+
+    threads = []
+    for i in xrange(numWorkers):
+        thread = threading.Thread(target=work, name=name + '-' + str(i + 1))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    try:
+        for item in items:
+            putInQueue(tasks, item)
+    except KeyboardInterrupt:
+        stopThreads(threads)
+        raise
+    for thread in threads:
+        putInQueue(tasks, None)
+    waitForThreads(threads)
+
+'''
+Wait for threads to finish. join() without a timeout can't be interrupted by
+Ctrl-C, so this checks twice a second. On Ctrl-C, the threads are stopped
+with stopThreads().
+'''
+def waitForThreads(threads):
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)
+    except KeyboardInterrupt:
+        stopThreads(threads)
+        raise
+
+'''
+After Ctrl-C, tell the download threads to stop (stopping) and give them a
+moment to do it, since they fail in strange ways while Python shuts down.
+'''
+def stopThreads(threads):
+    stopping.set()
+    stopTime = time.time() + STOP_WAIT
+    for thread in threads:
+        thread.join(max(0, stopTime - time.time()))
+
+'''
+Wait for an Event to be set, in a way that Ctrl-C can interrupt.
+'''
+def waitForEvent(event):
+    while not event.is_set():
+        event.wait(0.5)
+
+'''
+Get the next item from a Queue, in a way that Ctrl-C can interrupt.
+'''
+def getFromQueue(queue):
+    while True:
+        try:
+            return queue.get(True, 0.5)
+        except Queue.Empty:
+            pass
+
+'''
+Add an item to a Queue with a size limit, in a way that Ctrl-C can interrupt.
+'''
+def putInQueue(queue, item):
+    while True:
+        try:
+            queue.put(item, True, 0.5)
+            return
+        except Queue.Full:
+            pass
+
+'''
+Copy a download into a file.
+    response - The open download.
+    outFile - The file to write to, at the position the data belongs.
+    transfer - The Transfer the data is for.
+    segmentNum - Which of the transfer's pieces the data is for.
+    returns the number of bytes copied.
+'''
+def copyStream(response, outFile, transfer, segmentNum):
+    numBytes = 0
+    while True:
+        data = response.read(CHUNK_SIZE)
+        if not data:
+            break
+        outFile.write(data)
+        numBytes += len(data)
+        transfer.received(segmentNum, data)
+    return numBytes
+
+'''
+Raised while downloading a piece that is slower than --mirror-min-speed.
+'''
+class TooSlow(Exception):
+    pass
+
+'''
+Raised when a download ends early or isn't the size the stream map says (clen).
+'''
+class WrongSize(IOError):
+    pass
+
+'''
+Open the same range of a file on several mirrors at the same time.
+    urls - The URL of the file on each mirror.
+    start - The first byte.
+    end - The last byte, or None for the rest of the file.
+    returns (url, response) for the mirror that answered first. The other
+    responses are closed when they arrive.
+Raises the error of the first mirror if none of them work.
+'''
+def openFastest(urls, start, end):
+    results = Queue.Queue()
+    lock = threading.Lock()
+    chosen = []
+
+    def attempt(url):
+        try:
+            response = openStream(url, start, end)
+        except Exception, e:
+            results.put((url, None, e))
+            return
+        with lock:
+            if not chosen:
+                chosen.append(url)
+                results.put((url, response, None))
+                return
+        response.close()
+
+    for url in urls:
+        thread = threading.Thread(target=attempt, args=(url,))
+        thread.daemon = True
+        thread.start()
+
+    errors = {}
+    while len(errors) < len(urls):
+        url, response, error = getFromQueue(results)
+        if response is not None:
+            return url, response
+        errors[url] = error
+    raise errors[urls[0]]
+
+'''
+Download the format fmt to fileName.
+
+The data goes to fileName.part and is renamed to fileName once it's all
+there. What has been downloaded so far is saved in fileName.part.json, so if
+the download is interrupted the next run picks up where it left off.
+
+With --connections more than 1 the file is split into byte ranges that are
+downloaded over separate connections at the same time, since the servers
+limit the speed of each connection. If the server doesn't support ranges the
+file is downloaded over one connection.
+    fmt - The Format of the stream to download.
+    fileName - Where to save it.
+    progress - The Progress to report to.
+    streamNum - Which of the progress's downloads this is.
+    metrics - The VideoMetrics to add the download to, or None.
+    returns the hash of the file in hex with --hash, or None.
+A download that comes out the wrong size is tried again a few times.
+'''
+def retrieve(fmt, fileName, progress, streamNum, metrics=None):
+    transfer = Transfer(fmt, fileName, progress, streamNum)
+    activeTransfers.add(transfer)
+    startTime = time.time()
+    interrupted = False
+    try:
+        for attempt in xrange(VERIFY_RETRIES + 1):
+            try:
+                retrieveTransfer(transfer)
+                break
+            except WrongSize, e:
+                if attempt == VERIFY_RETRIES:
+                    raise
+                if not args.quiet:
+                    print str(e) + ' Trying again.'
+                # What was saved is counted again when the download continues.
+                progress.add(streamNum, -transfer.getNumDone())
+                transfer.retries += 1
+    except (KeyboardInterrupt, Stopped):
+        interrupted = True
+        raise
+    finally:
+        # An interrupted download stays in activeTransfers so how far it got is saved at exit.
+        if not interrupted:
+            activeTransfers.discard(transfer)
+        if metrics is not None:
+            metrics.addTransfer(transfer, startTime)
+    return transfer.digest
+
+'''
+Download the rest of a Transfer. See retrieve().
+'''
+def retrieveTransfer(transfer):
+    fileName = transfer.fileName
+    progress = transfer.progress
+    streamNum = transfer.streamNum
+
+    if transfer.load():
+        if not args.quiet and transfer.getNumDone() > 0:
+            print 'Resuming download: %s (%.1f of %s MB done)' % (fileName, \
+                transfer.getNumDone() / MB, \
+                '%.1f' % (transfer.size / MB) if transfer.size is not None else '?')
+    else:
+        size = transfer.clen
+        if args.connections > 1 and size is None:
+            size = getRemoteSize(transfer.url)
+        if args.connections > 1 and size is not None and size >= 2 * MIN_SEGMENT_SIZE:
+            if args.debug or args.superDebug:
+                print 'Downloading in up to ' + str(args.connections) + ' pieces: ' + fileName
+            transfer.start(size, min(args.connections, size // MIN_SEGMENT_SIZE))
+        else:
+            transfer.start(size, 1)
+
+    if transfer.size is not None:
+        progress.setTotal(streamNum, transfer.size)
+    progress.add(streamNum, transfer.getNumDone())
+
+    todo = [i for i in xrange(len(transfer.segments)) if not transfer.isSegmentDone(i)]
+    if todo:
+        # Open the first piece here to find out if the server supports ranges.
+        firstResponse = transfer.openSegment(todo[0])
+        if firstResponse is not None and transfer.isRange(todo[0]) and \
+           getattr(firstResponse, 'code', None) != 206:
+            # The server is sending the whole file instead. Start over with it.
+            if args.debug or args.superDebug:
+                print 'The server doesn\'t support ranges. Downloading in one piece: ' + fileName
+            progress.add(streamNum, -transfer.getNumDone())
+            transfer.retries += 1
+            length = firstResponse.info().getheader('Content-Length')
+            transfer.start(int(length) if length is not None and length.isdigit() else None, 1)
+            todo = [0]
+
+        functions = []
+        if firstResponse is not None:
+            functions.append(lambda: transfer.getSegment(todo[0], firstResponse))
+        for segmentNum in todo[1:]:
+            functions.append(lambda segmentNum=segmentNum: transfer.getSegment(segmentNum, None))
+        try:
+            runInParallel(functions)
+        finally:
+            transfer.save(True)
+
+    transfer.verify()
+    transfer.finish()
+
+'''
+Download the format fmt into a file that can only be written in order, like
+a pipe. This is done over one connection and can't be resumed.
+    fmt - The Format of the stream to download.
+    outFile - The open file to write to.
+    progress - The Progress to report to.
+    streamNum - Which of the progress's downloads this is.
+    metrics - The VideoMetrics to add the download to, or None.
+'''
+def retrieveToPipe(fmt, outFile, progress, streamNum, metrics=None):
+    transfer = Transfer(fmt, None, progress, streamNum)
+    transfer.segments = [[0, None, 0]]
+    if transfer.clen is not None:
+        progress.setTotal(streamNum, transfer.clen)
+
+    startTime = time.time()
+    try:
+        response = transfer.openSegment(0)
+        transfer.copySegment(0, response, outFile)
+        if transfer.clen is not None and transfer.numReceived != transfer.clen:
+            raise WrongSize('Download of the %s stream is %d bytes instead of %d.' % \
+                (transfer.itag, transfer.numReceived, transfer.clen))
+        if transfer.hash is not None:
+            transfer.digest = transfer.hash.hash.hexdigest()
+    finally:
+        if metrics is not None:
+            metrics.addTransfer(transfer, startTime)
+
+'''
+Save the progress of every unfinished download when the program exits, for
+example after Ctrl-C. The downloads run in threads that are stopped without
+any chance to clean up.
+'''
+def saveActiveTransfers():
+    for transfer in list(activeTransfers):
+        if transfer.segments:
+            transfer.save(True)
+
+'''
+One file being downloaded, possibly in several pieces at the same time.
+Each piece is a list of [start, end, numDone]: its first byte, its last byte
+(or None if the size isn't known), and how many of its bytes have been saved.
+'''
+class Transfer(object):
+
+    '''
+        See retrieve() for the arguments. fileName is None if the data isn't
+        saved to a file that can be resumed.
+    '''
+    def __init__(self, fmt, fileName, progress, streamNum):
+        self.url = fmt.url
+        # The same file is on the fallback host (--mirrors).
+        self.mirrors = [fmt.url]
+        if args.mirrors and fmt.fallbackHost and fmt.url:
+            parts = urlparse.urlsplit(fmt.url)
+            if fmt.fallbackHost != parts.netloc:
+                self.mirrors.append(urlparse.urlunsplit(parts._replace(netloc=fmt.fallbackHost)))
+        self.raced = False # True once the fastest mirror was chosen.
+        self.segmentURLs = {} # Piece number -> the URL it's downloading from.
+        self.speedChecks = {} # Piece number -> (time, bytes received since then).
+        self.itag = fmt.itag
+        self.clen = fmt.clen
+        self.size = None
+        self.fileName = fileName
+        if fileName is not None:
+            self.partName = fileName + '.part'
+            self.infoName = fileName + '.part.json'
+        self.progress = progress
+        self.streamNum = streamNum
+        self.segments = []
+        self.lock = threading.Lock()
+        self.lastSaved = 0
+        self.numReceived = 0 # Bytes received in this run, not counting what was resumed.
+        self.numDiscarded = 0 # Bytes received in this run that were thrown away by starting over.
+        self.retries = 0
+        self.hash = StreamHash(args.hash) if args.hash is not None else None
+        self.digest = None # The hash in hex once the file is verified.
+
+    '''
+    Read what was saved by an earlier, interrupted download of the same file.
+        returns True if the download can be continued.
+    '''
+    def load(self):
+        if not os.path.exists(self.partName):
+            return False
+        try:
+            with open(self.infoName) as infoFile:
+                info = json.load(infoFile)
+        except (IOError, ValueError):
+            return False
+        # Make sure it's the same stream. The URL itself changes from run to run.
+        if info.get('itag') != self.itag or info.get('clen') != self.clen:
+            return False
+
+        self.size = info['size']
+        self.segments = info['segments']
+        if len(self.segments) == 1:
+            # A single piece is written in order, so everything in the file is good,
+            # even if it was written after the info was last saved.
+            self.segments[0][2] = os.path.getsize(self.partName)
+            if self.size is not None:
+                self.segments[0][2] = min(self.segments[0][2], self.size)
+        return True
+
+    '''
+    Start downloading from scratch.
+        size - The size of the file, or None if it's not known.
+        numSegments - How many pieces to split it into.
+    '''
+    def start(self, size, numSegments):
+        self.size = size
+        self.numDiscarded = self.numReceived
+        if self.hash is not None:
+            self.hash = StreamHash(args.hash)
+        if size is None:
+            self.segments = [[0, None, 0]]
+        else:
+            segmentSize = (size + numSegments - 1) // numSegments
+            self.segments = [[start, min(start + segmentSize, size) - 1, 0] \
+                for start in xrange(0, size, segmentSize)]
+
+        with open(self.partName, 'wb') as outFile:
+            # Pieces are written where they belong, so make the file full size first.
+            if len(self.segments) > 1:
+                outFile.truncate(size)
+        self.save(True)
+
+    '''
+    Save what has been downloaded so far to the .part.json file. This is only
+    done every few seconds unless force is set.
+    '''
+    def save(self, force):
+        if self.fileName is None:
+            return
+        with self.lock:
+            if not force and time.time() - self.lastSaved < 2:
+                return
+            self.lastSaved = time.time()
+            info = {'url': self.url, 'itag': self.itag, 'clen': self.clen, \
+                'size': self.size, 'segments': self.segments}
+            # Write a new file and rename it so the info is never half written.
+            with open(self.infoName + '.tmp', 'w') as infoFile:
+                json.dump(info, infoFile)
+            os.rename(self.infoName + '.tmp', self.infoName)
+
+    '''
+    Count data that was saved to one of the pieces.
+    '''
+    def received(self, segmentNum, data):
+        numBytes = len(data)
+        with self.lock:
+            start, end, numDone = self.segments[segmentNum]
+            self.segments[segmentNum][2] += numBytes
+            self.numReceived += numBytes
+        if self.hash is not None:
+            self.hash.add(self, start + numDone, data)
+        self.progress.add(self.streamNum, numBytes)
+        self.save(False)
+        self.progress.throttle(numBytes)
+        self.progress.checkCancelled()
+        if stopping.is_set():
+            raise Stopped()
+        self.checkSpeed(segmentNum, numBytes)
+
+    '''
+    Check the speed of a piece every few seconds when there's a mirror to
+    switch to. It isn't checked with --limit-rate, which slows pieces down on purpose.
+    Raises TooSlow if the piece is slower than --mirror-min-speed.
+    '''
+    def checkSpeed(self, segmentNum, numBytes):
+        if len(self.mirrors) < 2 or limiter is not None:
+            return
+        now = time.time()
+        with self.lock:
+            checkTime, checkBytes = self.speedChecks.get(segmentNum, (now, 0))
+            checkBytes += numBytes
+            if now - checkTime < MIRROR_CHECK_TIME:
+                self.speedChecks[segmentNum] = (checkTime, checkBytes)
+                return
+            self.speedChecks[segmentNum] = (now, 0)
+        if checkBytes / (now - checkTime) < args.mirrorMinSpeed:
+            raise TooSlow()
+
+    '''
+        returns how many bytes of the file have been saved.
+    '''
+    def getNumDone(self):
+        return sum(numDone for start, end, numDone in self.segments)
+
+    '''
+        returns True if every byte of a piece has been saved.
+    '''
+    def isSegmentDone(self, segmentNum):
+        start, end, numDone = self.segments[segmentNum]
+        return end is not None and numDone >= end - start + 1
+
+    '''
+        returns True if the rest of a piece is only part of the file.
+    '''
+    def isRange(self, segmentNum):
+        start, end, numDone = self.segments[segmentNum]
+        return start + numDone > 0 or (end is not None and end < self.size - 1)
+
+    '''
+    Open the rest of a piece.
+        returns the response, or None if there's nothing left to get.
+    '''
+    def openSegment(self, segmentNum):
+        start, end, numDone = self.segments[segmentNum]
+        try:
+            # The first request goes to every mirror. The one that answers first is used from then on.
+            if not self.raced and len(self.mirrors) > 1:
+                self.raced = True
+                self.url, response = openFastest(self.mirrors, start + numDone, end)
+                if args.debug or args.superDebug:
+                    print 'Fastest mirror: ' + urlparse.urlsplit(self.url).netloc
+            else:
+                response = openStream(self.url, start + numDone, end)
+            self.segmentURLs[segmentNum] = self.url
+            with self.lock:
+                self.retries += getattr(response, 'retries', 0) # file:// responses don't have it.
+            return response
+        except urllib2.HTTPError, e:
+            # 416 Range Not Satisfiable: the file was already all there.
+            if e.code == 416 and end is None and start + numDone > 0:
+                self.size = start + numDone
+                return None
+            raise
+
+    '''
+    Download the rest of a piece.
+        response - The piece if it's already open, or None to open it.
+    '''
+    def getSegment(self, segmentNum, response):
+        if response is None:
+            response = self.openSegment(segmentNum)
+            if response is None:
+                return
+        start, end, numDone = self.segments[segmentNum]
+        if end is None:
+            # The size wasn't known before. The response may say how much is coming.
+            expectedEnd = self.getExpectedEnd(segmentNum, response)
+            if expectedEnd is not None:
+                self.progress.setTotal(self.streamNum, expectedEnd)
+        # Without buffering, the data is in the file as soon as it's counted,
+        # so the hash (--hash) can read what other pieces saved.
+        with open(self.partName, 'r+b', 0) as outFile:
+            outFile.seek(start + numDone)
+            expectedEnd = self.copySegment(segmentNum, response, outFile)
+        numDone = self.segments[segmentNum][2]
+
+        if end is None:
+            # Without a size, the piece is done when the server stops sending.
+            if expectedEnd is not None and start + numDone < expectedEnd:
+                raise WrongSize('Download of ' + self.fileName + ' ended early: got ' + \
+                    str(start + numDone) + ' of ' + str(expectedEnd) + ' bytes.')
+            self.size = start + numDone
+            self.progress.setTotal(self.streamNum, self.size)
+        elif not self.isSegmentDone(segmentNum):
+            raise WrongSize('Download of ' + self.fileName + ' ended early: got ' + \
+                str(self.getNumDone()) + ' of ' + str(self.size) + ' bytes.')
+
+    '''
+    Copy the rest of a piece to a file. If the server gets too slow, or the
+    connection breaks, the piece is continued from a mirror (--mirrors) at
+    the byte it got to.
+        response - The open piece. It's closed when this returns.
+        outFile - The file to write to, at the right place.
+        returns where the data of the last response should end, from its
+        Content-Length, or None if it didn't say.
+    '''
+    def copySegment(self, segmentNum, response, outFile):
+        try:
+            expectedEnd = self.getExpectedEnd(segmentNum, response)
+            while True:
+                try:
+                    copyStream(response, outFile, self, segmentNum)
+                    return expectedEnd
+                except (TooSlow, urllib2.URLError), e:
+                    mirrorResponse = self.openMirror(segmentNum)
+                    if mirrorResponse is None:
+                        if isinstance(e, TooSlow):
+                            continue # Nowhere better to go. Keep going here.
+                        raise
+                    response.close()
+                    response = mirrorResponse
+                    expectedEnd = self.getExpectedEnd(segmentNum, response)
+        finally:
+            response.close()
+
+    '''
+    Find where the data of a response that was just opened for a piece ends.
+        returns the position after its last byte, or None if it has no Content-Length.
+    '''
+    def getExpectedEnd(self, segmentNum, response):
+        start, end, numDone = self.segments[segmentNum]
+        length = response.info().getheader('Content-Length')
+        if length is None or not length.isdigit():
+            return None
+        return start + numDone + int(length)
+
+    '''
+    Open the rest of a piece on a mirror other than the one it's using.
+        returns the response, or None if no mirror can send it.
+    '''
+    def openMirror(self, segmentNum):
+        start, end, numDone = self.segments[segmentNum]
+        for url in self.mirrors:
+            if url == self.segmentURLs.get(segmentNum):
+                continue
+            try:
+                response = openStream(url, start + numDone, end)
+            except (urllib2.URLError, httplib.HTTPException, socket.error):
+                continue
+            # Data from the start of the file can't be used in the middle.
+            if start + numDone > 0 and getattr(response, 'code', None) != 206:
+                response.close()
+                continue
+            if not args.quiet:
+                print 'Switching %s to %s at %.1f MB.' % (self.fileName or 'download', \
+                    urlparse.urlsplit(url).netloc, (start + numDone) / MB)
+            self.url = url # Later pieces start here too.
+            self.segmentURLs[segmentNum] = url
+            with self.lock:
+                self.retries += 1
+            return response
+        return None
+
+    '''
+    Check that the whole file was saved and that it's the size the stream map
+    says (clen), and finish the hash. If it's the wrong size, what was saved
+    is deleted so the next try starts over.
+    Raises WrongSize.
+    '''
+    def verify(self):
+        size = os.path.getsize(self.partName)
+        expected = self.clen if self.clen is not None else self.size
+        if expected is not None and (size != expected or self.getNumDone() != expected):
+            self.discard()
+            raise WrongSize('Download of %s is %d bytes instead of %d.' % (self.fileName, size, expected))
+        if self.hash is not None:
+            self.digest = self.hash.finish(self)
+
+    '''
+    Delete what was saved and forget it.
+    '''
+    def discard(self):
+        self.progress.add(self.streamNum, -self.getNumDone())
+        self.segments = []
+        os.remove(self.partName)
+        os.remove(self.infoName)
+
+    '''
+    Put the finished file in place and delete the saved info.
+    '''
+    def finish(self):
+        os.rename(self.partName, self.fileName)
+        os.remove(self.infoName)
+
+'''
+A hash of a file (--hash) that's worked out while it downloads, so the file
+doesn't have to be read again afterwards. The data has to be hashed in order,
+but pieces (--connections) arrive out of order. Data at the point the hash has
+got to is hashed as it arrives. Data further on is read back from the .part
+file when the hash gets to it, which is usually while it's still in memory.
+'''
+class StreamHash(object):
+
+    '''
+        algorithm - The name of a hashlib algorithm, like "sha256".
+    '''
+    def __init__(self, algorithm):
+        self.hash = hashlib.new(algorithm)
+        self.offset = 0 # Everything before this has been hashed.
+        self.lock = threading.Lock()
+
+    '''
+    Add data that was just saved to a Transfer.
+        offset - Where the data is in the file.
+    '''
+    def add(self, transfer, offset, data):
+        with self.lock:
+            if offset == self.offset:
+                self.hash.update(data)
+                self.offset += len(data)
+            self.catchUp(transfer)
+
+    '''
+    Hash what the other pieces already saved after the point the hash got to.
+    '''
+    def catchUp(self, transfer):
+        if transfer.fileName is None: # Pipes are written in order.
+            return
+        while True:
+            for start, end, numDone in list(transfer.segments):
+                if start <= self.offset < start + numDone:
+                    break
+            else:
+                return
+            with open(transfer.partName, 'rb') as inFile:
+                inFile.seek(self.offset)
+                while self.offset < start + numDone:
+                    data = inFile.read(min(CHUNK_SIZE, start + numDone - self.offset))
+                    if not data:
+                        return
+                    self.hash.update(data)
+                    self.offset += len(data)
+
+    '''
+    Hash the rest of a Transfer that has finished.
+        returns the hash in hex.
+    '''
+    def finish(self, transfer):
+        with self.lock:
+            self.catchUp(transfer)
+            if self.offset != transfer.size:
+                raise IOError('The hash of ' + transfer.fileName + ' only got to ' + \
+                    str(self.offset) + ' of ' + str(transfer.size) + ' bytes.')
+            return self.hash.hexdigest()
+
+'''
+A single progress line for one or more downloads running at the same time.
+It's only shown on a terminal, and not when videos are downloaded in parallel
+(--jobs) since their output is saved up and printed later.
+
+Each Progress is one video, so it also holds the video's share of the
+bandwidth with --limit-rate. finish() must be called to give it back.
+'''
+class Progress(object):
+
+    '''
+        label - What to call the downloads.
+        numStreams - How many downloads are reported together.
+    '''
+    def __init__(self, label, numStreams):
+        self.label = label
+        self.received = [0] * numStreams
+        self.totals = [0] * numStreams # 0 until the size is known.
+        self.lock = threading.Lock()
+        self.lastShown = 0
+        self.show = not args.quiet and pool is None and jobQueue is None and sys.stdout.isatty()
+        self.bandwidth = limiter.join() if limiter is not None else None
+        # Let the daemon show the progress of the job and cancel it.
+        self.job = getattr(jobContext, 'job', None)
+        if self.job is not None:
+            self.job.progress = self
+
+    '''
+    Set the size of one of the downloads.
+    '''
+    def setTotal(self, streamNum, total):
+        with self.lock:
+            self.totals[streamNum] = total
+
+    '''
+    Count bytes received for one of the downloads.
+    '''
+    def add(self, streamNum, numBytes):
+        with self.lock:
+            self.received[streamNum] += numBytes
+            self.printLine(False)
+
+    '''
+    Wait until numBytes more can be downloaded without going over --limit-rate.
+    '''
+    def throttle(self, numBytes):
+        if self.bandwidth is not None:
+            self.bandwidth.take(numBytes)
+
+    '''
+    Stop the download if its daemon job was cancelled.
+    '''
+    def checkCancelled(self):
+        if self.job is not None and self.job.cancelled:
+            raise JobCancelled()
+
+    '''
+        returns (bytes received, total bytes or None if some sizes aren't known).
+    '''
+    def getStatus(self):
+        with self.lock:
+            return sum(self.received), sum(self.totals) if 0 not in self.totals else None
+
+    '''
+    Print the progress line. Only print it a few times a second unless force is set.
+    '''
+    def printLine(self, force):
+        if not self.show or (not force and time.time() - self.lastShown < 0.2):
+            return
+        self.lastShown = time.time()
+        received = sum(self.received)
+        line = '\r%s: %.1f MB' % (self.label, received / MB)
+        if 0 not in self.totals: # Every size is known.
+            total = sum(self.totals)
+            line += ' of %.1f MB (%.1f%%)' % (total / MB, 100.0 * received / total)
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+    '''
+    Print the final progress line.
+    '''
+    def finish(self):
+        self.printLine(True)
+        if self.show:
+            sys.stdout.write('\n')
+        if self.bandwidth is not None:
+            limiter.leave(self.bandwidth)
+            self.bandwidth = None
+
+'''
+Limits the speed of all downloads together (--limit-rate). Each video that is
+downloading gets an equal share of the rate, and the shares change whenever a
+video starts or finishes. The streams and pieces of one video (--combine,
+--connections) use the same share.
+'''
+class BandwidthLimiter(object):
+
+    '''
+        rate - The most bytes per second to download.
+    '''
+    def __init__(self, rate):
+        self.rate = rate
+        self.shares = set()
+        self.lock = threading.Lock()
+
+    '''
+    Start a share for a video.
+        returns the TokenBucket of the video.
+    '''
+    def join(self):
+        with self.lock:
+            share = TokenBucket(self.rate)
+            self.shares.add(share)
+            self.divide()
+            return share
+
+    '''
+    End the share of a video that finished. The other videos get its bandwidth.
+    '''
+    def leave(self, share):
+        with self.lock:
+            self.shares.discard(share)
+            self.divide()
+
+    '''
+    Split the rate evenly between the shares.
+    '''
+    def divide(self):
+        for share in self.shares:
+            share.setRate(float(self.rate) / len(self.shares))
+
+'''
+A token bucket. Tokens (bytes) are added at a steady rate up to a small limit,
+and every download takes out what it received, waiting when there isn't
+enough. Going below 0 is allowed so a whole chunk can be taken at once.
+'''
+class TokenBucket(object):
+
+    '''
+        rate - How many bytes per second are added.
+    '''
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = 0.0
+        self.lastFilled = time.time()
+        self.lock = threading.Lock()
+
+    '''
+    Add the tokens for the time since the last fill. The bucket holds at most a
+    quarter second of tokens (at least one chunk), so a pause can't be made up
+    with a burst.
+    '''
+    def fill(self):
+        now = time.time()
+        capacity = max(self.rate / 4, CHUNK_SIZE)
+        self.tokens = min(capacity, self.tokens + (now - self.lastFilled) * self.rate)
+        self.lastFilled = now
+
+    '''
+    Change the rate. Tokens up to now are added at the old rate.
+    '''
+    def setRate(self, rate):
+        with self.lock:
+            self.fill()
+            self.rate = rate
+
+    '''
+    Take numBytes tokens, waiting until the bucket isn't in debt.
+    '''
+    def take(self, numBytes):
+        with self.lock:
+            self.fill()
+            self.tokens -= numBytes
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+'''
+How long each part of downloading a video took (--metrics). The phases are:
+    pageFetch - Getting the watch page.
+    parse - Finding the title and formats on it.
+    select - Choosing the format, including waiting for the user to choose.
+    mux - Combining the video and audio with ffmpeg.
+Each download of a format is recorded separately, since the video and audio
+of --combine are downloaded at the same time.
+'''
+class VideoMetrics(object):
+
+    '''
+        url - The URL of the video.
+    '''
+    def __init__(self, url):
+        self.url = url
+        self.videoID = None
+        self.itag = None # The format, like "18" or "137+140" with --combine.
+        self.startTime = time.time()
+        self.phases = {} # Phase name -> seconds.
+        self.transfers = [] # A dict for each download.
+        self.retries = 0 # Requests made again, not counting the ones in transfers.
+        self.cached = False
+        self.skipped = False
+        self.success = False
+        self.error = None
+        self.lock = threading.Lock()
+
+    '''
+    Count the time from startTime to now for a phase.
+    '''
+    def addPhase(self, name, startTime):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0) + time.time() - startTime
+
+    '''
+    Record a Transfer that finished (or failed).
+        startTime - When it started.
+    '''
+    def addTransfer(self, transfer, startTime):
+        endTime = time.time()
+        seconds = endTime - startTime
+        with self.lock:
+            self.transfers.append({'itag': transfer.itag, 'start': startTime, 'end': endTime, \
+                'seconds': seconds, 'bytes': transfer.numReceived, \
+                'bytesPerSecond': transfer.numReceived / seconds if seconds > 0 else None, \
+                'resumedBytes': transfer.getNumDone() - (transfer.numReceived - transfer.numDiscarded) \
+                    if transfer.segments else 0, \
+                'connections': len(transfer.segments), 'retries': transfer.retries, \
+                'hash': args.hash + ':' + transfer.digest if transfer.digest is not None else None})
+
+    '''
+    Get how much was downloaded and how long it took. The downloads of --combine
+    overlap, so the time is from the start of the first to the end of the last.
+        returns (bytes, seconds). seconds is None if nothing was downloaded.
+    '''
+    def getDownloaded(self):
+        with self.lock:
+            numBytes = sum(transfer['bytes'] for transfer in self.transfers)
+            seconds = None
+            if self.transfers:
+                seconds = max(transfer['end'] for transfer in self.transfers) - \
+                    min(transfer['start'] for transfer in self.transfers)
+            return numBytes, seconds
+
+    '''
+        returns 'downloaded', 'simulated', 'skipped' or 'failed'.
+    '''
+    def getResult(self):
+        if self.skipped:
+            return 'skipped'
+        elif not self.success:
+            return 'failed'
+        elif args.simulate:
+            return 'simulated'
+        return 'downloaded'
+
+    '''
+        returns the metrics as a dict for JSON.
+    '''
+    def toDict(self):
+        numBytes, seconds = self.getDownloaded()
+        with self.lock:
+            transfers = [dict(transfer) for transfer in self.transfers]
+            for transfer in transfers:
+                del transfer['start'], transfer['end']
+            return {'url': self.url, 'videoID': self.videoID, 'itag': self.itag, 'result': self.getResult(), \
+                'error': self.error, 'time': self.startTime, 'seconds': time.time() - self.startTime, \
+                'cached': self.cached, 'phases': dict(self.phases), 'transfers': transfers, \
+                'bytes': numBytes, 'bytesPerSecond': numBytes / seconds if seconds else None, \
+                'retries': self.retries + sum(transfer['retries'] for transfer in transfers)}
+
+'''
+The --metrics file. Each video adds one line of JSON to it.
+'''
+class MetricsLog(object):
+
+    '''
+        fileName - The file to add to. It's made if it doesn't exist.
+    '''
+    def __init__(self, fileName):
+        self.file = open(fileName, 'a')
+        self.lock = threading.Lock()
+
+    '''
+    Add a record. It's written right away so nothing is lost if the program is stopped.
+    '''
+    def write(self, record):
+        line = json.dumps(record, sort_keys=True)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
 
 '''
 Get user input for the video to download.
@@ -445,12 +2870,193 @@ def getVideoNumInput(numOptions):
 
     return videoNum
 
+'''
+Find the audio to combine with an adaptive video.
+    allFormats - Every Format of the video.
+    videoNum - The number of the video, starting with 1.
+    returns the number of the audio.
+'''
+def getAudioNum(allFormats, videoNum):
+    audioNum = None
+    matchinAudioFormat = 'audio/mp4' # Default format.
+    if allFormats[videoNum - 1].type == 'video/webm': matchinAudioFormat = 'audio/webm' # Match webm video with webm audio
+    for i in xrange(len(allFormats)):
+        if allFormats[i].type == matchinAudioFormat:
+            audioNum = i + 1 # The first matching audio. TODO: We should search by highest bitrate. It's not in descending bitrate order for the webm audio for video fhdIYS2gOBU
+    return audioNum
+
+'''
+    returns True if a size or time budget (--max-size or --max-time) is set.
+'''
+def isBudgetSet():
+    return args.maxSize is not None or args.maxTime is not None
+
+'''
+Guess the size of a format in bytes. The adaptive formats have their size
+(clen), and the URLs of most formats have it too. Otherwise it's worked out
+from the bitrate and the length of the video.
+    fmt - The Format.
+    returns the size, or None if there's no way to tell.
+'''
+def getFormatSize(fmt):
+    if fmt.clen is not None:
+        return fmt.clen
+    query = urlparse.parse_qs(urlparse.urlsplit(fmt.url or '').query)
+    try:
+        if 'clen' in query:
+            return int(query['clen'][0])
+        if fmt.bitrate is not None and 'dur' in query:
+            return int(fmt.bitrate * float(query['dur'][0]) / 8)
+    except ValueError:
+        pass
+    return None
+
+'''
+Find how many bytes downloading a video will be, with the format that
+getSelectedVideoNum() chooses and the audio that goes with it (--combine).
+Sizes that aren't in the stream map are asked for with a HEAD request.
+    info - The VideoInfo.
+    returns the size, or None if it can't be found.
+'''
+def getDownloadSize(info):
+    allFormats = info.videos + info.adaptiveVideos
+    if not allFormats:
+        return None
+    videoNum = getSelectedVideoNum(info)
+    formats = [allFormats[videoNum - 1]]
+    if videoNum > len(info.videos) and args.combine and formats[0].type is not None and \
+       not formats[0].type.startswith('audio/'):
+        audioNum = getAudioNum(allFormats, videoNum)
+        if audioNum is not None:
+            formats.append(allFormats[audioNum - 1])
+
+    total = 0
+    for fmt in formats:
+        size = getFormatSize(fmt)
+        if size is None and fmt.url:
+            size = getRemoteSize(fmt.url)
+        if size is None:
+            return None
+        total += size
+    return total
+
+'''
+Choose the best video that fits in the size and time budget (--max-size and
+--max-time). Both lists are used: the formats with video and audio, and with
+--combine every adaptive video together with the audio that would be combined
+with it. The time budget is turned into bytes with the speed of the downloads
+so far. If nothing fits, the smallest video is chosen.
+    allFormats - Every Format of the video.
+    numNormalVideos - How many of them have both video and audio.
+    fmtListDict - The dimensions of each format with video and audio.
+    returns the number of the video to download.
+'''
+def getBudgetVideoNum(allFormats, numNormalVideos, fmtListDict):
+    budget = getByteBudget()
+
+    # (number, size, pixels) of each choice. Sizes that aren't known are None.
+    choices = []
+    for i in xrange(len(allFormats)):
+        fmt = allFormats[i]
+        if i < numNormalVideos:
+            size = getFormatSize(fmt)
+            dimensions = fmtListDict.get(fmt.itag)
+        elif args.combine and fmt.type is not None and fmt.type.startswith('video/'):
+            audioNum = getAudioNum(allFormats, i + 1)
+            if audioNum is None:
+                continue
+            size = getFormatSize(fmt)
+            audioSize = getFormatSize(allFormats[audioNum - 1])
+            size = size + audioSize if size is not None and audioSize is not None else None
+            dimensions = fmt.size
+        else:
+            continue
+        match = re.match(r'(\d+)x(\d+)$', dimensions or '')
+        pixels = int(match.group(1)) * int(match.group(2)) if match else 0
+        choices.append((i + 1, size, pixels))
+
+    if not choices:
+        return 1
+
+    # The most pixels wins, then the biggest size (the highest bitrate).
+    fits = [choice for choice in choices if choice[1] is not None and choice[1] <= budget]
+    if fits:
+        videoNum, size, pixels = max(fits, key=lambda choice: (choice[2], choice[1]))
+    else:
+        known = [choice for choice in choices if choice[1] is not None]
+        if known:
+            videoNum, size, pixels = min(known, key=lambda choice: choice[1])
+        else: # No sizes at all. Take the one with the fewest pixels.
+            videoNum, size, pixels = min(choices, key=lambda choice: choice[2])
+        if not args.quiet:
+            print 'WARNING: No video fits in the budget of %.1f MB. Downloading the smallest one.' % (budget / MB)
+
+    if args.debug or args.superDebug:
+        print 'Budget: %.1f MB. Chose video number %d (%s MB).' % (budget / MB, videoNum, \
+            '%.1f' % (size / MB) if size is not None else '?')
+    return videoNum
+
+'''
+Choose the video to download without asking, with -M, -m, -P, -p, --max-size
+or --max-time.
+    info - The VideoInfo.
+    returns the number of the video to download.
+'''
+def getSelectedVideoNum(info):
+    if isBudgetSet():
+        return getBudgetVideoNum(info.videos + info.adaptiveVideos, len(info.videos), info.fmtList or {})
+    return getAutoVideoNum(info.videos) # TODO make the "highest quality" option check the adaptive formats
+
+'''
+Get the most bytes a video can have to stay in the budget.
+'''
+def getByteBudget():
+    budget = float('inf')
+    if args.maxSize is not None:
+        budget = args.maxSize
+    if args.maxTime is not None:
+        speed = speedEstimate.get()
+        if speed is None:
+            speed = DEFAULT_SPEED
+        # Each video only gets its share of --limit-rate.
+        if limiter is not None:
+            speed = min(speed, float(limiter.rate) / args.jobs)
+        budget = min(budget, args.maxTime * speed)
+    return budget
+
+'''
+The download speed of each video, averaged over the videos downloaded so far
+(--max-time). Recent videos count more, since the speed can change during a run.
+'''
+class SpeedEstimate(object):
+
+    WEIGHT = 0.3 # How much the newest video counts.
+
+    def __init__(self):
+        self.speed = None
+        self.lock = threading.Lock()
+
+    '''
+    Add the speed of a video that finished, in bytes per second.
+    '''
+    def add(self, speed):
+        with self.lock:
+            if self.speed is None:
+                self.speed = speed
+            else:
+                self.speed = self.WEIGHT * speed + (1 - self.WEIGHT) * self.speed
+
+    '''
+        returns the average speed, or None if nothing has been downloaded yet.
+    '''
+    def get(self):
+        with self.lock:
+            return self.speed
+
 '''
 Automatically choose a video to download based on the command line options.
-    videos - A list of video data. Each element is a dict that represents
+    videos - A list of video data. Each element is a Format that represents
              one type of video.
-             The keys of the dict are:
-             itag, url, quality, fallback_host, and type
 
     returns the number of the video to download.
 '''
@@ -469,14 +3075,14 @@ def getAutoVideoNum(videos):
     elif args.maxMP4:
         for i in xrange(len(videos)):
             # The video is an MP4.
-            if videos[i]['type'] == 'video/mp4':
+            if videos[i].type == 'video/mp4':
                 return i + 1 # Return the first (highest quality) MP4 video.
 
     # Get the lowest quality MP4 video.
     elif args.minMP4:
         for i in xrange(len(videos)):
             # The video is an MP4.
-            if videos[i]['type'] == 'video/mp4':
+            if videos[i].type == 'video/mp4':
                 validVideos.append(i)
         # Return the last (lowest quality) MP4 video. 
         return validVideos[len(validVideos) - 1] + 1
@@ -487,6 +3093,423 @@ def getAutoVideoNum(videos):
 
     return videoNum
 
+'''
+A stand-in for sys.stdout that sends what each download thread prints to its
+own buffer, so the output of videos downloaded at the same time isn't mixed
+together. Threads without a buffer print straight to the real stdout.
+'''
+class ThreadOutput(object):
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    '''
+    Start saving everything this thread prints.
+    '''
+    def startBuffer(self):
+        self.local.buffer = StringIO.StringIO()
+
+    '''
+    Stop saving what this thread prints.
+        returns everything the thread printed since startBuffer().
+    '''
+    def stopBuffer(self):
+        text = self.local.buffer.getvalue()
+        self.local.buffer = None
+        return text
+
+    def write(self, data):
+        # Encode unicode text the same way printing it would.
+        if isinstance(data, unicode):
+            data = data.encode(getattr(self.stream, 'encoding', None) or 'utf-8', 'replace')
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            self.stream.write(data)
+        else:
+            buffer.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    # Everything else (encoding, isatty(), ...) comes from the real stream.
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+'''
+A bounded pool of threads that download several videos at once (--jobs).
+Each video is fetched, parsed and saved by one thread. The output of each
+video is printed in the order the videos were given, followed by a status
+line, and a summary is printed once every video is done.
+'''
+class DownloadPool(object):
+
+    '''
+        numJobs - The number of videos to download at the same time.
+    '''
+    def __init__(self, numJobs):
+        # Don't let the queue get too far ahead of the threads. This keeps
+        # playlists from being read much faster than they can be downloaded.
+        self.tasks = Queue.Queue(2 * numJobs)
+        self.lock = threading.Lock()
+        self.finished = {} # Job number -> (url, result, output, seconds) for finished jobs that haven't been printed.
+        self.numSubmitted = 0
+        self.nextToPrint = 0
+        self.numSucceeded = 0
+        self.numSkipped = 0
+        self.numFailed = 0
+        self.startTime = time.time()
+
+        self.threads = []
+        for i in xrange(numJobs):
+            thread = threading.Thread(target=self.work, name='download-' + str(i + 1))
+            thread.daemon = True # Don't keep the program alive after Ctrl-C.
+            thread.start()
+            self.threads.append(thread)
+
+    '''
+    Add a video to the queue. This waits if the queue is full.
+        url - The URL of the video to download.
+    '''
+    def submit(self, url):
+        putInQueue(self.tasks, (self.numSubmitted, url))
+        self.numSubmitted += 1
+
+    '''
+    Download videos from the queue until finish() is called.
+    '''
+    def work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None or stopping.is_set(): # finish() was called, or Ctrl-C.
+                return
+            jobNum, url = task
+
+            startTime = time.time()
+            sys.stdout.startBuffer()
+            try:
+                result = download(url)
+            except Stopped: # Ctrl-C. The video is saved to be continued later.
+                return
+            except Exception:
+                # One bad video shouldn't take down the rest of the batch.
+                print '\nERROR: Unexpected error for ' + url
+                traceback.print_exc(file=sys.stdout)
+                result = 'failed'
+            output = sys.stdout.stopBuffer()
+
+            with self.lock:
+                self.finished[jobNum] = (url, result, output, time.time() - startTime)
+                self.printFinished()
+
+    '''
+    Print the output of every finished video that isn't waiting on an
+    earlier video. The lock must be held.
+    '''
+    def printFinished(self):
+        while self.nextToPrint in self.finished:
+            url, result, output, seconds = self.finished.pop(self.nextToPrint)
+            self.nextToPrint += 1
+
+            if result == 'skipped':
+                self.numSkipped += 1
+                status = 'skipped'
+            elif result == 'failed':
+                self.numFailed += 1
+                status = 'FAILED'
+            else:
+                self.numSucceeded += 1
+                status = 'done'
+
+            sys.stdout.write(output)
+            if not args.quiet:
+                print '[%d] %s: %s (%.1f s)' % (self.nextToPrint, status, url, seconds)
+            sys.stdout.flush()
+
+    '''
+    Wait for every queued video to finish and print a summary.
+    '''
+    def finish(self):
+        for thread in self.threads:
+            putInQueue(self.tasks, None)
+        waitForThreads(self.threads)
+
+        if not args.quiet:
+            print '\n%d of %d videos downloaded (%d skipped, %d failed) in %.1f s.' % \
+                (self.numSucceeded, self.numSubmitted, self.numSkipped, self.numFailed, \
+                time.time() - self.startTime)
+
+'''
+Raised in a download when its daemon job is cancelled.
+'''
+class JobCancelled(Exception):
+    pass
+
+'''
+Raised in the threads of a download when the program is stopped with Ctrl-C.
+'''
+class Stopped(Exception):
+    pass
+
+'''
+A video to download in the daemon (--daemon).
+'''
+class Job(object):
+
+    '''
+        jobID - The number of the job.
+        url - The URL of the video.
+    '''
+    def __init__(self, jobID, url):
+        self.jobID = jobID
+        self.url = url
+        self.state = 'queued' # queued, running, done, skipped, failed or cancelled.
+        self.cancelled = False
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.progress = None # The Progress of the download once it starts.
+        self.output = '' # What was printed while downloading.
+
+    '''
+        returns the job as a dict for JSON.
+    '''
+    def toDict(self):
+        received, total = self.progress.getStatus() if self.progress is not None else (0, None)
+        return {'id': self.jobID, 'url': self.url, 'state': self.state, \
+            'submitted': self.submitted, 'started': self.started, 'finished': self.finished, \
+            'received': received, 'total': total, 'output': self.output}
+
+'''
+The queue of the daemon. The jobs are downloaded by a fixed number of threads
+(--jobs) in the order they were submitted. Unlike DownloadPool there's no
+limit on how many jobs can wait. Everything is kept until the daemon stops,
+so the connections, the cache and --limit-rate are shared by every job.
+'''
+class JobQueue(object):
+
+    '''
+        numWorkers - The number of videos to download at the same time.
+    '''
+    def __init__(self, numWorkers):
+        self.jobs = {} # Job ID -> Job.
+        self.nextID = 1
+        self.tasks = Queue.Queue()
+        self.lock = threading.Lock()
+
+        for i in xrange(numWorkers):
+            thread = threading.Thread(target=self.work, name='job-' + str(i + 1))
+            thread.daemon = True
+            thread.start()
+
+    '''
+    Add a video to the end of the queue.
+        returns the new Job.
+    '''
+    def submit(self, url):
+        with self.lock:
+            job = Job(self.nextID, url)
+            self.jobs[job.jobID] = job
+            self.nextID += 1
+        self.tasks.put(job)
+        return job
+
+    '''
+        returns the Job with the ID, or None if there isn't one.
+    '''
+    def get(self, jobID):
+        with self.lock:
+            return self.jobs.get(jobID)
+
+    '''
+        returns every Job, oldest first.
+    '''
+    def getAll(self):
+        with self.lock:
+            return [self.jobs[jobID] for jobID in sorted(self.jobs)]
+
+    '''
+    Cancel a job. A queued job is never started. A running job stops at its
+    next chunk of data, leaving its .part files so it can be continued later.
+        returns the Job, or None if there isn't one with the ID.
+    '''
+    def cancel(self, jobID):
+        with self.lock:
+            job = self.jobs.get(jobID)
+            if job is not None and job.state in ('queued', 'running'):
+                job.cancelled = True
+                if job.state == 'queued':
+                    job.state = 'cancelled'
+                    job.finished = time.time()
+            return job
+
+    '''
+    Download jobs from the queue forever.
+    '''
+    def work(self):
+        while True:
+            job = self.tasks.get()
+            with self.lock:
+                if job.cancelled:
+                    continue
+                job.state = 'running'
+                job.started = time.time()
+
+            jobContext.job = job
+            sys.stdout.startBuffer()
+            try:
+                result = download(job.url)
+                state = result if result in ('skipped', 'failed') else 'done'
+            except JobCancelled:
+                print 'Cancelled: ' + job.url
+                state = 'cancelled'
+            except Exception:
+                # One bad video shouldn't take down the daemon.
+                print '\nERROR: Unexpected error for ' + job.url
+                traceback.print_exc(file=sys.stdout)
+                state = 'failed'
+            output = sys.stdout.stopBuffer()
+            jobContext.job = None
+
+            with self.lock:
+                job.state = state
+                job.finished = time.time()
+                job.output = output
+            if not args.quiet:
+                print '[%d] %s: %s (%.1f s)' % (job.jobID, state, job.url, job.finished - job.started)
+                sys.stdout.flush()
+
+'''
+The job API of the daemon. Requests and responses are JSON.
+
+    POST /jobs                {"url": URL} or {"urls": [URL, ...]}. Playlists
+                              add a job for each video. Returns the new jobs.
+    GET /jobs                 Every job.
+    GET /jobs/ID              One job, with its progress in bytes.
+    DELETE /jobs/ID           Cancel a job. POST /jobs/ID/cancel works too.
+'''
+class DaemonHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/jobs':
+            return self.sendJSON(200, {'jobs': [job.toDict() for job in jobQueue.getAll()]})
+        job = self.getJob()
+        if job is not None:
+            self.sendJSON(200, job.toDict())
+
+    def do_POST(self):
+        if self.path.rstrip('/').endswith('/cancel'):
+            return self.cancelJob()
+        if self.path.rstrip('/') != '/jobs':
+            return self.sendJSON(404, {'error': 'Not found: ' + self.path})
+
+        try:
+            length = int(self.headers.getheader('Content-Length') or 0)
+            request = json.loads(self.rfile.read(length))
+            urls = request['urls'] if 'urls' in request else [request['url']]
+            urls = [url.encode('utf-8') for url in urls]
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return self.sendJSON(400, {'error': 'Expected {"url": URL} or {"urls": [URL, ...]}.'})
+
+        jobs = []
+        try:
+            for url in urls:
+                for videoURL in getVideoURLs(url):
+                    jobs.append(jobQueue.submit(videoURL))
+        except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+            # A playlist couldn't be read. Keep the jobs that were added.
+            return self.sendJSON(502, {'error': 'Couldn\'t read the playlist: ' + str(e), \
+                'jobs': [job.toDict() for job in jobs]})
+        if not jobs:
+            return self.sendJSON(400, {'error': 'No videos found.'})
+        self.sendJSON(201, {'jobs': [job.toDict() for job in jobs]})
+
+    def do_DELETE(self):
+        self.cancelJob()
+
+    def cancelJob(self):
+        job = self.getJob()
+        if job is not None:
+            jobQueue.cancel(job.jobID)
+            self.sendJSON(200, job.toDict())
+
+    '''
+    Find the job in the path (/jobs/ID or /jobs/ID/cancel). Sends a 404 if there isn't one.
+        returns the Job, or None.
+    '''
+    def getJob(self):
+        match = re.match(r'^/jobs/(\d+)(/cancel)?/?$', self.path)
+        job = jobQueue.get(int(match.group(1))) if match else None
+        if job is None:
+            self.sendJSON(404, {'error': 'Not found: ' + self.path})
+        return job
+
+    def sendJSON(self, code, data):
+        body = json.dumps(data, sort_keys=True) + '\n'
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Unix sockets have no client address to log, and the jobs print their own lines.
+
+class DaemonServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class UnixDaemonServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+'''
+Run the daemon: serve the job API and download the jobs until stopped (Ctrl-C).
+    address - A port or host:port to serve HTTP on, or the path of a Unix
+              socket (anything with a "/" in it).
+'''
+def runDaemon(address):
+    global jobQueue
+    sys.stdout = ThreadOutput(sys.stdout)
+    jobQueue = JobQueue(args.jobs)
+
+    if '/' in address:
+        # A socket left behind by a daemon that was killed would stop bind().
+        if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+            os.remove(address)
+        server = UnixDaemonServer(address, DaemonHandler)
+        atexit.register(os.remove, address)
+    else:
+        host, port = address.rsplit(':', 1) if ':' in address else ('127.0.0.1', address)
+        server = DaemonServer((host, int(port)), DaemonHandler)
+
+    # Videos given on the command line are the first jobs.
+    for url in args.URLs:
+        for videoURL in getArgumentURLs(url):
+            jobQueue.submit(videoURL)
+
+    # Stop the same way for kill as for Ctrl-C, so unfinished downloads are saved.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    if not args.quiet:
+        print 'Waiting for jobs on ' + address
+        sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+'''
+Read a number of bytes like "500K" or "2M" (--limit-rate and --max-size).
+    text - The argument.
+    returns the number of bytes.
+'''
+def getByteCount(text):
+    match = re.match(r'^(\d+(?:\.\d+)?)([kKmMgG]?)$', text.strip())
+    if not match:
+        raise argparse.ArgumentTypeError('not a number of bytes: ' + text)
+    multipliers = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    return float(match.group(1)) * multipliers[match.group(2).lower()]
+
 '''
 Set up argparse and get the arguments.
 '''
@@ -517,6 +3540,77 @@ def getArguments():
     parser.add_argument('-c', '--combine', dest='combine', \
         action='store_true', help='Automatically download combine videos that are split up into separate audio and video files.\nNOTE: The bitrate seems to be better for a single video with audio built in than for a split-up video of the same resolution. Download complete videos if possible.')
 
+    # Combine the video and audio while they download.
+    parser.add_argument('--stream-mux', dest='streamMux', \
+        action='store_true', help='With --combine, feed the video and audio to ffmpeg through pipes while they download instead of saving them to temporary files first. This needs no extra disk space and finishes sooner. If ffmpeg can\'t read the streams this way they are downloaded to temporary files.')
+
+    # Download several videos at the same time.
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1, \
+        metavar='N', help='Download up to N videos at the same time. Needs one of the quality options (-M, -m, -P or -p) or a budget (--max-size or --max-time) since there is no way to choose a video for each download. The default is 1.')
+
+    # Download each file over several connections.
+    parser.add_argument('-k', '--connections', dest='connections', type=int, default=1, \
+        metavar='N', help='Download each file in up to N pieces at the same time. The servers limit the speed of each connection, so this can be much faster. The default is 1.')
+
+    # Limit the speed.
+    parser.add_argument('--limit-rate', dest='limitRate', type=getByteCount, \
+        metavar='RATE', help='Download at most RATE bytes per second in total, split evenly between the videos that are downloading. RATE can end in K, M or G, like 500K or 2M.')
+
+    # Download each video and format only once.
+    parser.add_argument('--store', dest='store', metavar='DIR', \
+        help='Save each video in DIR by video ID and format, and make the file with its title a hard link to it (or a copy if that can\'t be done). Videos that are already in DIR aren\'t downloaded again, and the same video isn\'t downloaded twice at the same time.')
+
+    # Parse saved pages now and download them later.
+    parser.add_argument('--extract', dest='extract', metavar='MANIFEST', \
+        help='Don\'t download anything. Parse the saved watch pages given as arguments (or every .html file in directories given as arguments) in parallel and write the title, ID and formats of each to MANIFEST as a line of JSON ("-" for stdout). --jobs sets the number of processes. The default is one for each CPU.')
+    parser.add_argument('--manifest', dest='manifest', metavar='MANIFEST', \
+        help='Download the videos in a MANIFEST made by --extract ("-" for stdin) without parsing any pages, unless their download URLs have expired.')
+
+    # Get formats only.
+    parser.add_argument('--crawl', dest='crawl', metavar='FILE', \
+        help='Don\'t download anything. Get the title and every format of each video and write them to FILE as a line of JSON per video ("-" for stdout), in the order they finish. Many pages are fetched at once: --jobs sets how many (16 by default). With no URLs, they\'re read from stdin, one per line.')
+    parser.add_argument('--crawl-per-host', dest='crawlPerHost', type=int, default=8, \
+        metavar='N', help='With --crawl, make at most N requests to each server at the same time. The default is 8.')
+
+    # Run as a daemon.
+    parser.add_argument('--daemon', dest='daemon', metavar='ADDRESS', \
+        help='Run until stopped, downloading the videos that are sent to a JSON API on ADDRESS, which is a port (on localhost), host:port or the path of a Unix socket. Jobs are added with POST /jobs {"url": URL}, shown with GET /jobs and GET /jobs/ID and cancelled with DELETE /jobs/ID. --jobs sets how many are downloaded at the same time.')
+
+    # Use the fallback hosts of the formats.
+    parser.add_argument('--mirrors', dest='mirrors', action='store_true', \
+        help='Request each file from its normal server and from its fallback server at the same time and download it from the one that answers first. Switch a download to the other server if it gets slower than --mirror-min-speed or the connection breaks.')
+    parser.add_argument('--mirror-min-speed', dest='mirrorMinSpeed', type=getByteCount, default=64 * 1024, \
+        metavar='RATE', help='With --mirrors, switch servers when a download is slower than RATE bytes per second. The default is 64K.')
+
+    # Check the downloads.
+    parser.add_argument('--hash', dest='hash', metavar='ALGORITHM', \
+        help='Work out a hash of each file while it downloads, like sha256 or md5, and save it next to the file in FILE.ALGORITHM (the format of sha256sum -c) and in --metrics. Combined videos (--combine) only have the hashes of their streams in --metrics. Every download is checked against the size given by YouTube and downloaded again if it\'s wrong, with or without --hash.')
+
+    # Download order.
+    parser.add_argument('--order', dest='order', choices=['given', 'shortest', 'largest', 'deadline'], default='given', \
+        help='The order to download the videos in. "given" starts each one as soon as it\'s found. The others first get the watch page of every video to find the size of its format, then download the smallest first ("shortest"), the biggest first ("largest"), or the earliest deadline first ("deadline"). With "deadline", a URL can end in @SECONDS to be done within SECONDS of the start, like URL@600. The default is "given".')
+
+    # Connection options.
+    parser.add_argument('--pool-size', dest='poolSize', type=int, default=8, \
+        metavar='N', help='Keep up to N idle connections open to each server for reuse. The default is 8.')
+    parser.add_argument('--keep-alive', dest='keepAlive', type=float, default=30, \
+        metavar='SECONDS', help='Close connections that have been idle for this long. 0 uses a new connection for every request. The default is 30.')
+
+    # Skip videos that were already downloaded.
+    parser.add_argument('--archive', dest='archive', metavar='FILE', \
+        help='Keep a list of downloaded videos in FILE and skip every video that is in it. Useful for downloading the new videos of playlists again and again.')
+
+    # Record how long everything takes.
+    parser.add_argument('--metrics', dest='metrics', metavar='FILE', \
+        help='Add a line of JSON to FILE for each video with how long getting the page, parsing it, choosing the format, each download and ffmpeg took, and the bytes, speed and retries of the downloads.')
+
+    # Cache options.
+    parser.add_argument('--cache', dest='cacheDir', metavar='DIR', \
+        help='Save the data from each watch page in DIR and use it instead of getting the page again, for example after --simulate or when running a batch again.')
+    parser.add_argument('--cache-ttl', dest='cacheTTL', type=float, default=3600, \
+        metavar='SECONDS', help='How long cached video data is used. It\'s never used after its download URLs expire. The default is 3600.')
+    parser.add_argument('--cache-size', dest='cacheSize', type=int, default=1000, \
+        metavar='N', help='Keep at most N videos in the cache, removing the least recently used ones. The default is 1000.')
 
     # Name collision options.
     nameGroup = parser.add_mutually_exclusive_group()
@@ -536,6 +3630,12 @@ def getArguments():
     qualityGroup.add_argument('-p', '--min-mp4', dest='minMP4', \
         action='store_true', help='Download the lowest quality mp4 video without user input.')
 
+    # Choose the video by size instead (these can't be used with the options above).
+    parser.add_argument('--max-size', dest='maxSize', type=getByteCount, \
+        metavar='SIZE', help='Download the best video that is at most SIZE bytes, like 200M. With --combine the adaptive videos are included, counting the size of their audio too.')
+    parser.add_argument('--max-time', dest='maxTime', type=float, \
+        metavar='SECONDS', help='Download the best video that should take at most SECONDS to download at the speed of the videos downloaded so far (1 MB/s until the first one is done). Can be used together with --max-size.')
+
     # Output options.
     outputGroup = parser.add_mutually_exclusive_group()
     outputGroup.add_argument('-q', '--quiet', dest='quiet', \
@@ -550,5 +3650,51 @@ def getArguments():
     # Read the arguments.
     args = parser.parse_args()
 
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1.')
+    if args.connections < 1:
+        parser.error('--connections must be at least 1.')
+    if args.limitRate is not None and args.limitRate <= 0:
+        parser.error('--limit-rate must be more than 0.')
+    budgetSet = args.maxSize is not None or args.maxTime is not None
+    if budgetSet and (args.maxQuality or args.minQuality or args.maxMP4 or args.minMP4):
+        parser.error('--max-size and --max-time can\'t be used with -M, -m, -P or -p.')
+    if (args.maxSize is not None and args.maxSize <= 0) or (args.maxTime is not None and args.maxTime <= 0):
+        parser.error('--max-size and --max-time must be more than 0.')
+    if args.extract is not None and (args.manifest is not None or args.daemon is not None):
+        parser.error('--extract can\'t be used with --manifest or --daemon.')
+    if args.crawl is not None and (args.extract is not None or args.manifest is not None or \
+                                   args.daemon is not None or args.files):
+        parser.error('--crawl can\'t be used with --extract, --manifest, --daemon or --files.')
+    if args.hash is not None:
+        args.hash = args.hash.lower()
+        try:
+            hashlib.new(args.hash)
+        except ValueError:
+            parser.error('unknown --hash algorithm: ' + args.hash)
+    if args.crawlPerHost < 1:
+        parser.error('--crawl-per-host must be at least 1.')
+    if args.manifest is not None and (args.URLs or args.files or args.daemon is not None):
+        parser.error('--manifest can\'t be used with URLs, --files or --daemon.')
+    # Parallel downloads can't stop and ask which video to get.
+    if args.jobs > 1 and args.extract is None and args.crawl is None and \
+       not (args.maxQuality or args.minQuality or args.maxMP4 or args.minMP4 or budgetSet):
+        parser.error('--jobs needs one of -M, -m, -P, -p, --max-size or --max-time.')
+    if args.order != 'given':
+        if not (args.maxQuality or args.minQuality or args.maxMP4 or args.minMP4 or budgetSet):
+            parser.error('--order needs one of -M, -m, -P, -p, --max-size or --max-time.')
+        if args.daemon is not None or args.extract is not None or args.crawl is not None:
+            parser.error('--order can\'t be used with --daemon, --extract or --crawl.')
+    if args.jobs > 1 and args.promptName:
+        parser.error('--jobs can\'t be used with --prompt-name.')
+    # Nobody is there to answer questions in the daemon either.
+    if args.daemon is not None:
+        if not (args.maxQuality or args.minQuality or args.maxMP4 or args.minMP4 or budgetSet):
+            parser.error('--daemon needs one of -M, -m, -P, -p, --max-size or --max-time.')
+        if args.promptName:
+            parser.error('--daemon can\'t be used with --prompt-name.')
+        if args.files:
+            parser.error('--daemon can\'t be used with --files.')
+
 if __name__ == '__main__':
     main()